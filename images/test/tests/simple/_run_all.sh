@@ -10,3 +10,6 @@ set -x
 ./test-fkey.sh
 ./test-filter.sh
 ./test-batch-dir.sh
+./test-bisect.sh
+./test-bulk.sh
+./test-dispatch.sh
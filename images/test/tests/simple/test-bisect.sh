@@ -0,0 +1,117 @@
+#! /bin/bash
+
+# Test batch retry after error.
+# Failing chunk of statements is bisected under savepoints down to failing event,
+# after the cause is fixed the batch is applied fully.
+
+source ../testlib.sh
+
+../zstop.sh
+
+source ./init.sh
+
+v='-q'
+v=''
+
+db_list="db1 db2"
+
+kdb_list=`echo $db_list | sed 's/ /,/g'`
+
+title Bisect test
+
+# create ticker conf
+cat > conf/pgqd.ini <<EOF
+[pgqd]
+database_list = $kdb_list
+logfile = log/pgqd.log
+pidfile = pid/pgqd.pid
+EOF
+
+# londiste configs
+for db in $db_list; do
+cat > conf/londiste_$db.ini <<EOF
+[londiste]
+job_name = londiste_$db
+db = dbname=$db
+queue_name = replika
+logfile = $LOG_DIR/%(job_name)s.log
+pidfile = pid/%(job_name)s.pid
+
+pgq_autocommit = 1
+pgq_lazy_fetch = 0
+EOF
+done
+
+for db in $db_list; do
+  cleardb $db
+done
+
+clearlogs
+
+set -e
+
+msg "Install londiste and initialize nodes"
+run londiste $v conf/londiste_db1.ini create-root node1 'dbname=db1'
+run londiste $v conf/londiste_db2.ini create-leaf node2 'dbname=db2' --provider='dbname=db1'
+
+msg "Run ticker"
+run pgqd $v -d conf/pgqd.ini
+run sleep 5
+
+msg "Run londiste daemon for each node"
+for db in $db_list; do
+  run psql -d $db -c "update pgq.queue set queue_ticker_idle_period='2 secs'"
+  run londiste $v -d conf/londiste_$db.ini worker
+done
+
+msg "Create table, on db2 it refuses value 'bad'"
+run psql -d db1 -c "create table mytable (id int4 primary key, data text)"
+run psql -d db2 -c "create table mytable (id int4 primary key, data text check (data <> 'bad'))"
+
+run londiste $v conf/londiste_db1.ini add-table mytable
+run londiste $v conf/londiste_db2.ini add-table mytable --handler=londiste --handler-arg=multirow=1
+run londiste conf/londiste_db2.ini wait-sync
+
+msg "Change rows in one transaction, one event fails on db2"
+run psql -d db1 -c "
+    begin;
+    insert into mytable select n, 'row' || n from generate_series(1, 40) n;
+    update mytable set data = 'bad' where id = 23;
+    update mytable set data = 'row23x' where id = 23;
+    insert into mytable values (41, 'bad');
+    commit;
+"
+run sleep 15
+
+msg "Check failing chunk was bisected"
+
+if ! grep -q 'statements failed, bisecting' log/londiste_db2.log; then
+    echo "No bisect in log!"
+    exit 1
+fi
+if ! grep -q 'mytable_data_check' log/londiste_db2.log; then
+    echo "Failing statement not in log!"
+    exit 1
+fi
+
+ROW_COUNT=$(psql -qtAX -d db2 -c "select count(*) from mytable")
+if [[ $ROW_COUNT -ne 0 ]]; then
+    echo "Rows of failed batch applied: $ROW_COUNT"
+    exit 1
+fi
+
+msg "Drop check on db2, batch is applied"
+run psql -d db2 -c "alter table mytable drop constraint mytable_data_check"
+run sleep 15
+
+SRC=$(psql -qtAX -d db1 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from mytable")
+DST=$(psql -qtAX -d db2 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from mytable")
+if [[ "$SRC" != "$DST" ]]; then
+    echo "Tables differ!"
+    exit 1
+fi
+
+echo
+echo "Everything is OK"
+
+exit 0
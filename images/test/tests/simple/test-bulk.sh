@@ -0,0 +1,122 @@
+#! /bin/bash
+
+# Test bulk handler.
+# Rows buffered over spill_size are moved to temp files and merged back on flush,
+# with merge=1 rows are applied with single MERGE statement (PostgreSQL 15+).
+
+source ../testlib.sh
+
+../zstop.sh
+
+source ./init.sh
+
+v='-q'
+v=''
+
+db_list="db1 db2"
+
+kdb_list=`echo $db_list | sed 's/ /,/g'`
+
+title Bulk handler test
+
+# create ticker conf
+cat > conf/pgqd.ini <<EOF
+[pgqd]
+database_list = $kdb_list
+logfile = log/pgqd.log
+pidfile = pid/pgqd.pid
+EOF
+
+# londiste configs
+for db in $db_list; do
+cat > conf/londiste_$db.ini <<EOF
+[londiste]
+job_name = londiste_$db
+db = dbname=$db
+queue_name = replika
+logfile = $LOG_DIR/%(job_name)s.log
+pidfile = pid/%(job_name)s.pid
+
+pgq_autocommit = 1
+pgq_lazy_fetch = 0
+
+handler_modules = londiste.handlers.bulk
+EOF
+done
+
+for db in $db_list; do
+  cleardb $db
+done
+
+clearlogs
+
+set -e
+
+msg "Install londiste and initialize nodes"
+run londiste $v conf/londiste_db1.ini create-root node1 'dbname=db1'
+run londiste $v conf/londiste_db2.ini create-leaf node2 'dbname=db2' --provider='dbname=db1'
+
+msg "Run ticker"
+run pgqd $v -d conf/pgqd.ini
+run sleep 5
+
+msg "Run londiste daemon for each node"
+run psql -d db1 -c "update pgq.queue set queue_ticker_idle_period='2 secs'"
+run psql -d db2 -c "update pgq.queue set queue_ticker_idle_period='2 secs'"
+run londiste $v -d conf/londiste_db1.ini worker
+run londiste -v -d conf/londiste_db2.ini worker
+
+msg "Create tables"
+for db in $db_list; do
+  run psql -d $db -c "create table spilltable (id int4 primary key, data text)"
+  run psql -d $db -c "create table mergetable (id int4 primary key, data text)"
+done
+
+run londiste $v conf/londiste_db1.ini add-table spilltable mergetable
+run londiste $v conf/londiste_db2.ini add-table spilltable --handler=bulk --handler-arg=spill_size=2k
+run londiste $v conf/londiste_db2.ini add-table mergetable --handler=bulk --handler-arg=merge=1
+run londiste conf/londiste_db2.ini wait-sync
+
+msg "Change rows in one transaction"
+for tbl in spilltable mergetable; do
+  run psql -d db1 -c "
+      begin;
+      insert into $tbl select n, 'row' || n from generate_series(1, 500) n;
+      commit;
+      begin;
+      insert into $tbl select n, 'row' || n from generate_series(501, 600) n;
+      update $tbl set data = data || 'x' where id % 3 = 0;
+      delete from $tbl where id % 7 = 0;
+      update $tbl set data = data || 'y' where id % 5 = 0;
+      insert into $tbl values (700, 'gone');
+      delete from $tbl where id = 700;
+      commit;
+  "
+done
+run sleep 15
+
+msg "Check rows were spilled"
+if ! grep -q 'spilling' log/londiste_db2.log; then
+    echo "No spill in log!"
+    exit 1
+fi
+
+msg "Compare tables"
+for tbl in spilltable mergetable; do
+  SRC=$(psql -qtAX -d db1 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from $tbl")
+  DST=$(psql -qtAX -d db2 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from $tbl")
+  if [[ "$SRC" != "$DST" ]]; then
+      echo "Table $tbl differs!"
+      exit 1
+  fi
+done
+
+if grep -q 'mismatch' log/londiste_db2.log; then
+    echo "Mismatch in log!"
+    exit 1
+fi
+
+echo
+echo "Everything is OK"
+
+exit 0
@@ -0,0 +1,123 @@
+#! /bin/bash
+
+# Test dispatch handler.
+# Rows are split into daily partitions by field value, partitions are created on the fly.
+# With max_loaders=2 idle partition loaders are dropped and recreated when needed again.
+
+source ../testlib.sh
+
+../zstop.sh
+
+source ./init.sh
+
+v='-q'
+v=''
+
+db_list="db1 db2"
+
+kdb_list=`echo $db_list | sed 's/ /,/g'`
+
+title Dispatch handler test
+
+# create ticker conf
+cat > conf/pgqd.ini <<EOF
+[pgqd]
+database_list = $kdb_list
+logfile = log/pgqd.log
+pidfile = pid/pgqd.pid
+EOF
+
+# londiste configs
+for db in $db_list; do
+cat > conf/londiste_$db.ini <<EOF
+[londiste]
+job_name = londiste_$db
+db = dbname=$db
+queue_name = replika
+logfile = $LOG_DIR/%(job_name)s.log
+pidfile = pid/%(job_name)s.pid
+
+pgq_autocommit = 1
+pgq_lazy_fetch = 0
+
+handler_modules = londiste.handlers.dispatch
+EOF
+done
+
+for db in $db_list; do
+  cleardb $db
+done
+
+clearlogs
+
+set -e
+
+msg "Install londiste and initialize nodes"
+run londiste $v conf/londiste_db1.ini create-root node1 'dbname=db1'
+run londiste $v conf/londiste_db2.ini create-leaf node2 'dbname=db2' --provider='dbname=db1'
+
+msg "Run ticker"
+run pgqd $v -d conf/pgqd.ini
+run sleep 5
+
+msg "Run londiste daemon for each node"
+run psql -d db1 -c "update pgq.queue set queue_ticker_idle_period='2 secs'"
+run psql -d db2 -c "update pgq.queue set queue_ticker_idle_period='2 secs'"
+run londiste $v -d conf/londiste_db1.ini worker
+run londiste -v -d conf/londiste_db2.ini worker
+
+msg "Create tables"
+for db in $db_list; do
+  run psql -d $db -c "create table events (id int4 primary key, ts timestamptz not null, data text)"
+done
+
+run londiste $v conf/londiste_db1.ini add-table events
+run londiste $v conf/londiste_db2.ini add-table events --expect-sync --handler=bulk_daily_field \
+    --handler-arg=part_field=ts --handler-arg=max_loaders=2
+run londiste conf/londiste_db2.ini wait-sync
+
+msg "Insert rows for 5 days"
+run psql -d db1 -c "
+    insert into events
+    select n, '2026-01-01'::timestamptz + (n % 5) * interval '1 day', 'row' || n
+      from generate_series(1, 100) n;
+"
+run sleep 10
+
+msg "Change rows of partitions not used lately"
+run psql -d db1 -c "
+    begin;
+    update events set data = data || 'x' where ts < '2026-01-02';
+    delete from events where ts >= '2026-01-02' and ts < '2026-01-03';
+    commit;
+"
+run sleep 10
+
+msg "Check partitions"
+PART_COUNT=$(psql -qtAX -d db2 -c "select count(*) from pg_tables where tablename like 'events_2026_01_%'")
+if [[ $PART_COUNT -ne 5 ]]; then
+    echo "Expected 5 partitions, got: $PART_COUNT"
+    exit 1
+fi
+if ! grep -q 'dropping idle loader' log/londiste_db2.log; then
+    echo "No loaders dropped!"
+    exit 1
+fi
+
+msg "Compare tables"
+SRC=$(psql -qtAX -d db1 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from events")
+DST=$(psql -qtAX -d db2 -c "select md5(string_agg(id || ':' || data, ',' order by id)) from events")
+if [[ "$SRC" != "$DST" ]]; then
+    echo "Tables differ!"
+    exit 1
+fi
+
+if grep -q 'mismatch' log/londiste_db2.log; then
+    echo "Mismatch in log!"
+    exit 1
+fi
+
+echo
+echo "Everything is OK"
+
+exit 0
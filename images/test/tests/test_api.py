@@ -1,8 +1,708 @@
 """just test import"""
 
+import doctest
+import logging
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+from pgq.event import Event
+from skytools import db_urlencode
+
 import londiste
+import londiste.bincopy
+import londiste.copy_pool
+import londiste.event_filter
+import londiste.fkey_validator
+import londiste.handler
+import londiste.handlers.bulk
+import londiste.handlers.dispatch
+import londiste.handlers.shard
+import londiste.metrics
+import londiste.playback
+import londiste.prefetch
 
 
 def test_one():
     assert londiste
 
+
+def test_doctests():
+    for mod in (londiste.bincopy, londiste.event_filter, londiste.handler, londiste.handlers.bulk,
+                londiste.handlers.dispatch, londiste.metrics):
+        assert doctest.testmod(mod).failed == 0, mod.__name__
+
+
+def event_row(op, data, extra3=None):
+    return {'ev_id': 1, 'ev_time': None, 'ev_txid': 1, 'ev_retry': None,
+            'ev_type': '%s:id' % op, 'ev_data': db_urlencode(data), 'ev_extra1': 'public.t',
+            'ev_extra2': None, 'ev_extra3': extra3, 'ev_extra4': None}
+
+
+def make_event(op, data, extra3=None):
+    return Event('q', event_row(op, data, extra3))
+
+
+def test_shard_handler(monkeypatch):
+    shard = londiste.handlers.shard
+    monkeypatch.setattr(shard, '_SHARD_MASK', 1)
+    monkeypatch.setattr(shard, '_SHARD_NR', 0)
+    h = shard.ShardHandler('public.t', {'hash_key': 'id'}, None)
+    args = []
+    h.add(args)
+    assert args[0] == "ev_extra3='hash='||partconf.get_hash_raw(id)"
+    h.prepare_batch(None, None, None)
+    sql = []
+    h.process_event(make_event('I', {'id': '2'}, 'hash=2'), lambda q, a: sql.append(q), None)
+    h.process_event(make_event('I', {'id': '3'}, 'hash=3'), lambda q, a: sql.append(q), None)
+    h.finish_batch(None, None)
+    assert sql == ["insert into public.t (id) values ('2');"]
+
+
+def test_shard_handler_without_hash_key(monkeypatch):
+    class Unsharded(londiste.handlers.shard.ShardHandler):
+        def _validate_hash_key(self):
+            pass
+
+    monkeypatch.setattr(londiste.handlers.shard, '_SHARD_MASK', None)
+    h = Unsharded('public.t', {}, None)
+    args = []
+    h.add(args)
+    assert not any(a.startswith('ev_extra3') for a in args)
+    assert h.get_copy_condition(None, None) == ''
+    # no shard info is loaded
+    h.prepare_batch(None, None, None)
+    sql = []
+    h.process_event(make_event('I', {'id': '3'}), lambda q, a: sql.append(q), None)
+    assert sql == ["insert into public.t (id) values ('3');"]
+    assert h.get_copy_event(make_event('I', {'id': '3'}), 'q') is not None
+
+
+def test_rewrites_copy_event():
+    assert not londiste.handler.TableHandler('public.t', {}, None).rewrites_copy_event()
+    assert londiste.handlers.shard.ShardHandler('public.t', {'hash_key': 'id'}, None).rewrites_copy_event()
+    h = londiste.handlers.dispatch.Dispatcher('public.t', {'table_mode': 'direct'}, None)
+    assert not h.rewrites_copy_event()
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.sql = []
+
+    def execute(self, sql, args=None):
+        self.sql.append(sql)
+
+
+def test_dispatch_routes_events():
+    h = londiste.handlers.dispatch.Dispatcher('public.t', {'table_mode': 'direct'}, None)
+    curs = RecordingCursor()
+    h.prepare_batch(None, None, curs)
+    h.process_event(make_event('I', {'id': '1', 'v': 'a'}), None, curs)
+    h.process_event(make_event('U', {'id': '1', 'v': 'b'}), None, curs)
+    assert list(h.row_handler.table_map) == ['public.t']
+    h.finish_batch(None, curs)
+    assert curs.sql == ["insert into public.t (id, v) values ('1', 'a');\n"
+                        "update only public.t set v = 'b' where id = '1';"]
+
+
+def test_dispatch_max_rows():
+    h = londiste.handlers.dispatch.Dispatcher('public.t', {'table_mode': 'direct', 'max_rows': '2'}, None)
+    curs = RecordingCursor()
+    h.prepare_batch(None, None, curs)
+    for i in range(3):
+        h.process_event(make_event('I', {'id': str(i)}), None, curs)
+    # first two rows are flushed mid-batch
+    assert len(curs.sql) == 1
+    h.finish_batch(None, curs)
+    assert curs.sql[1] == "insert into public.t (id) values ('2');"
+
+
+def test_parsed_row_used():
+    ev = make_event('I', {'id': '1'})
+    # row decoded by partial sync filter
+    row = {'id': '7'}
+    bulk = londiste.handlers.bulk.BulkLoader('public.t', {}, None)
+    bulk.set_parsed_row(ev, row)
+    bulk.process_event(ev, None, None)
+    assert list(bulk.pkey_ev_map) == [('7',)]
+    h = londiste.handlers.dispatch.Dispatcher('public.t', {'table_mode': 'direct'}, None)
+    curs = RecordingCursor()
+    h.prepare_batch(None, None, curs)
+    h.set_parsed_row(ev, row)
+    h.process_event(ev, None, curs)
+    h.finish_batch(None, curs)
+    assert curs.sql == ["insert into public.t (id) values ('7');"]
+
+
+class FlushCounter(londiste.handlers.dispatch.BaseLoader):
+    def process(self, op, row):
+        pass
+
+    def flush(self, curs):
+        self.conf['flushed'].append(self.table)
+
+
+def test_row_handler_flushes_only_used_loaders():
+    flushed = []
+    rh = londiste.handlers.dispatch.RowHandler(None, max_loaders=10)
+    rh.add_table('public.t_1', FlushCounter, ['id'], {'flushed': flushed})
+    rh.add_table('public.t_2', FlushCounter, ['id'], {'flushed': flushed})
+    rh.process('public.t_1', 'I', {'id': '1'})
+    rh.flush(None)
+    assert flushed == ['public.t_1']
+    rh.flush(None)
+    assert flushed == ['public.t_1']
+
+
+Notify = namedtuple('Notify', 'pid channel payload')
+
+
+class NotifyConn:
+    """Connection with socket, second backend writes its pid there."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.notifies = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def get_backend_pid(self):
+        return self.pid
+
+    def commit(self):
+        pass
+
+    def poll(self):
+        try:
+            data = self.sock.recv(1024)
+        except BlockingIOError:
+            return
+        for pid in data.split():
+            self.notifies.append(Notify(int(pid), 'londiste_table_state', 'set'))
+
+    def notify(self, pid, delay):
+        threading.Timer(delay, self.peer.send, [b'%d ' % pid]).start()
+
+
+def wait_table_state(conn, timeout):
+    script = SimpleNamespace(table_state_notify=True)
+    start = time.time()
+    londiste.playback.Replicator.wait_table_state(script, conn, timeout)
+    return time.time() - start
+
+
+def test_wait_table_state_notify():
+    conn = NotifyConn(100)
+    conn.notify(200, 0.1)
+    assert wait_table_state(conn, 5) < 2
+    assert conn.notifies == []
+
+
+def test_wait_table_state_own_notify():
+    conn = NotifyConn(100)
+    conn.notify(100, 0.1)
+    assert wait_table_state(conn, 0.5) >= 0.5
+
+
+def test_flush_on_retry():
+    # per-event flush in retry mode only where it just queues statements
+    assert londiste.handler.TableHandler.flush_on_retry
+    assert not londiste.handlers.bulk.BulkLoader.flush_on_retry
+    assert not londiste.handlers.dispatch.Dispatcher.flush_on_retry
+
+
+def make_replicator(**attrs):
+    """Replicator without config and databases, for testing single methods."""
+    r = londiste.playback.Replicator.__new__(londiste.playback.Replicator)
+    r.log = logging.getLogger('test')
+    r.stat_dict = {}
+    r.work_state = 1
+    r.current_event = None
+    r.sql_list = []
+    r.sql_events = []
+    r.sql_count = 0
+    r.sql_bytes = 0
+    r.apply_batch_count = 200
+    r.apply_batch_bytes = 0
+    r.apply_batch_delay = 0
+    r.apply_batch_autotune = False
+    r.__dict__.update(attrs)
+    return r
+
+
+def test_prepared_statements_reconnect():
+    r = make_replicator(prepared_statements=londiste.handler.PreparedStatementCache(10),
+                        replica_mode_enabled=False)
+    h = londiste.handler.TableHandler('public.t', {'prepared': '1'}, None)
+    curs = RecordingCursor()
+    h.process_event(make_event('I', {'id': '1', 'v': 'a'}), r.apply_sql, curs)
+    h.process_event(make_event('I', {'id': '2', 'v': 'b'}), r.apply_sql, curs)
+    r.flush_sql(curs)
+    assert curs.sql == ["prepare londiste_stmt_1 as insert into public.t (id, v) values ($1, $2);\n"
+                        "execute londiste_stmt_1 ('1', 'a');\n"
+                        "execute londiste_stmt_1 ('2', 'b');"]
+    # statement is reused in next batch
+    h.process_event(make_event('I', {'id': '3', 'v': 'c'}), r.apply_sql, curs)
+    r.flush_sql(curs)
+    assert curs.sql[-1] == "execute londiste_stmt_1 ('3', 'c');"
+    # new session has no statements
+    r.connection_hook('db', None)
+    h.process_event(make_event('I', {'id': '4', 'v': 'd'}), r.apply_sql, curs)
+    r.flush_sql(curs)
+    assert curs.sql[-1] == ("prepare londiste_stmt_2 as insert into public.t (id, v) values ($1, $2);\n"
+                            "execute londiste_stmt_2 ('4', 'd');")
+    # DDL drops them in same session
+    r.prepared_statements.clear(curs)
+    assert curs.sql[-1] == "deallocate all"
+    assert not r.prepared_statements.stmt_map
+
+
+def test_apply_batch_limits():
+    curs = RecordingCursor()
+    r = make_replicator(apply_batch_count=3)
+    for i in range(4):
+        r.apply_sql("select %d;" % i, curs)
+    assert curs.sql == ["select 0;\nselect 1;\nselect 2;"]
+
+    curs = RecordingCursor()
+    r = make_replicator(apply_batch_bytes=30)
+    for i in range(3):
+        r.apply_sql("select %d, 'xxxxxxxxxx';" % i, curs)
+    assert curs.sql == ["select 0, 'xxxxxxxxxx';\nselect 1, 'xxxxxxxxxx';"]
+
+    curs = RecordingCursor()
+    r = make_replicator(apply_batch_delay=0.05)
+    r.apply_sql("select 0;", curs)
+    time.sleep(0.06)
+    r.apply_sql("select 1;", curs)
+    assert curs.sql == ["select 0;\nselect 1;"]
+
+
+def test_apply_batch_autotune():
+    r = make_replicator(apply_batch_target_latency=0.1)
+    r.autotune_apply_batch(1.0)
+    assert r.apply_batch_count == 150
+    r.autotune_apply_batch(0.01)
+    assert r.apply_batch_count == 225
+    # within target, no change
+    r.autotune_apply_batch(0.08)
+    assert r.apply_batch_count == 225
+    r.apply_batch_count = londiste.playback.AUTOTUNE_MIN_COUNT
+    r.autotune_apply_batch(1.0)
+    assert r.apply_batch_count == londiste.playback.AUTOTUNE_MIN_COUNT
+
+
+class QueryCursor(RecordingCursor):
+    """Returns rows for first statement pattern found in query."""
+
+    def __init__(self, results):
+        super().__init__()
+        self.results = results
+        self.rows = []
+        self.args = []
+
+    def execute(self, sql, args=None):
+        super().execute(sql, args)
+        self.args.append(args)
+        self.rows = []
+        for pat, rows in self.results.items():
+            if pat in sql:
+                self.rows = rows
+                break
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+def table_row(name, **attrs):
+    row = {'table_name': name, 'local': True, 'merge_state': 'ok', 'custom_snapshot': None,
+           'table_attrs': None, 'copy_role': None, 'dropped_ddl': None, 'dest_table': None}
+    row.update(attrs)
+    return row
+
+
+def make_state_replicator():
+    return make_replicator(table_list=[], table_map={}, set_name='set', event_filter_config={},
+                           cf=SimpleNamespace(has_option=lambda opt: False),
+                           copy_method_map={}, threaded_copy_tables=[])
+
+
+def test_table_state_reload_skipped():
+    r = make_state_replicator()
+    curs = QueryCursor({'from londiste.table_info': [('stamp1',)],
+                        'londiste.get_table_list': [table_row('public.t')]})
+    r.load_table_state(curs)
+    assert list(r.table_map) == ['public.t']
+    t = r.table_map['public.t']
+    # same stamp, state is not read again
+    curs.sql = []
+    r.load_table_state(curs)
+    assert len(curs.sql) == 1 and 'get_table_list' not in curs.sql[0]
+    assert r.table_map['public.t'] is t
+    # changed table_info is read again
+    curs.results['from londiste.table_info'] = [('stamp2',)]
+    curs.results['londiste.get_table_list'] = [table_row('public.t'), table_row('public.t2')]
+    r.load_table_state(curs)
+    assert sorted(r.table_map) == ['public.t', 'public.t2']
+
+
+class BatchDB:
+    """Provider connection serving event rows by fetch_size."""
+
+    def __init__(self, count, fail_at=None):
+        self.rows = [dict(event_row('I', {'id': str(i)}), ev_id=i) for i in range(count)]
+        self.fail_at = fail_at
+        self.pos = 0
+        self.chunk = []
+        self.fetch_size = 0
+        self.committed = self.rolled_back = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, args=None):
+        if 'get_batch_cursor' in sql:
+            self.fetch_size = args[2]
+        elif not sql.startswith('fetch'):
+            return
+        if self.fail_at is not None and self.pos >= self.fail_at:
+            raise ValueError('fetch failed')
+        self.chunk = self.rows[self.pos:self.pos + self.fetch_size]
+        self.pos += len(self.chunk)
+
+    def fetchall(self):
+        return self.chunk
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+def test_prefetch_walker():
+    db = BatchDB(25)
+    walker = londiste.prefetch.PrefetchBatchWalker(db, 1, 'q', fetch_size=10, max_chunks=1)
+    assert [ev.ev_id for ev in walker] == list(range(25))
+    assert len(walker) == 25
+    assert db.committed and walker.thread is None
+
+
+def test_prefetch_walker_stop():
+    db = BatchDB(100)
+    walker = londiste.prefetch.PrefetchBatchWalker(db, 1, 'q', fetch_size=10, max_chunks=1)
+    for ev in walker:
+        break
+    # thread waiting on full queue notices stop
+    walker.stop()
+    assert walker.thread is None
+    assert db.pos < 100
+
+
+def test_prefetch_walker_error():
+    db = BatchDB(25, fail_at=10)
+    walker = londiste.prefetch.PrefetchBatchWalker(db, 1, 'q', fetch_size=10)
+    with pytest.raises(ValueError):
+        list(walker)
+    assert db.rolled_back
+
+
+class FakePool:
+    """Executor that runs submitted copies inline."""
+
+    def __init__(self, results):
+        self.results = results
+        self.submitted = []
+        self.is_shutdown = False
+
+    def submit(self, func, args):
+        self.submitted.append(args)
+        fut = Future()
+        res = self.results[args[-1]]
+        if isinstance(res, BaseException):
+            fut.set_exception(res)
+        elif res is not None:
+            fut.set_result(res)
+        return fut
+
+    def shutdown(self, wait=True):
+        self.is_shutdown = True
+
+
+def test_copy_scheduler():
+    sched = londiste.copy_pool.CopyScheduler(2, logging.getLogger('test'))
+    sched.pool = pool = FakePool({'t1': 0, 't2': 3, 't3': ValueError('boom'), 't4': None})
+    for tbl in ('t1', 't2', 't3', 't4'):
+        sched.submit(tbl, ['conf.ini', 'copy', tbl])
+    with pytest.raises(Exception):
+        sched.submit('t4', ['conf.ini', 'copy', 't4'])
+    assert sorted(sched.poll()) == [('t1', 'ok'), ('t2', 'exit 3'), ('t3', 'failed: boom')]
+    assert sched.poll() == []
+    assert sched.is_running('t4') and not sched.is_running('t1')
+    assert pool.submitted[0] == ['conf.ini', 'copy', 't1']
+
+    sched.shutdown()
+    assert pool.is_shutdown and sched.pool is None and not sched.running
+
+
+def test_copy_scheduler_broken_pool():
+    sched = londiste.copy_pool.CopyScheduler(1, logging.getLogger('test'))
+    sched.pool = pool = FakePool({'t1': BrokenProcessPool('died')})
+    sched.submit('t1', ['conf.ini', 'copy', 't1'])
+    assert sched.poll() == [('t1', 'failed: died')]
+    # next submit starts new pool
+    assert pool.is_shutdown and sched.pool is None
+
+
+class QueryDB:
+    def __init__(self, curs):
+        self.curs = curs
+        self.commits = 0
+
+    def cursor(self):
+        return self.curs
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_copy_order():
+    sizes = {'a': 500, 'b': 10, 'c': 5000, 'd': 20000}
+    tables = [SimpleNamespace(name=n) for n in ('a', 'b', 'c', 'd', 'e')]
+    r = make_replicator(copy_large_table_size=1000)
+    res = {}
+    for order in londiste.playback.COPY_ORDERS:
+        r.copy_order = order
+        res[order] = [t.name for t in r.order_copy_tables(tables, sizes)]
+    assert res['default'] == ['a', 'b', 'c', 'd', 'e']
+    assert res['smallest'] == ['e', 'b', 'a', 'c', 'd']
+    assert res['largest'] == ['d', 'c', 'a', 'b', 'e']
+    # small ones first, then large ones biggest first
+    assert res['fair'] == ['e', 'b', 'a', 'd', 'c']
+
+
+def test_provider_table_sizes():
+    ok, missing = londiste.playback.TABLE_OK, londiste.playback.TABLE_MISSING
+    r = make_replicator(table_list=[SimpleNamespace(name='public.a', state=missing),
+                                    SimpleNamespace(name='public.b', state=ok),
+                                    SimpleNamespace(name='public.c', state=missing)])
+    pmap = {'public.a': SimpleNamespace(dest_table='public.a'),
+            'public.b': SimpleNamespace(dest_table='public.b')}
+    db = QueryDB(QueryCursor({'pg_class': [{'name': 'public.a', 'size': 8192}]}))
+    assert r.get_provider_table_sizes(db, pmap) == {'public.a': 8192}
+    # only tables not yet copied and present on provider are asked
+    assert db.curs.args == [[['public.a'], ['public.a']]]
+    assert db.commits == 1
+
+    r.table_list[0].state = ok
+    db.curs.sql = []
+    assert r.get_provider_table_sizes(db, pmap) == {}
+    assert db.curs.sql == []
+
+
+def state_table(name, changed, dest_table=None, state='ok'):
+    return SimpleNamespace(name=name, dest_table=name, changed=changed, str_snapshot=None,
+                           plugin=SimpleNamespace(dest_table=dest_table or name),
+                           render_state=lambda: state)
+
+
+def test_save_table_state():
+    r = make_state_replicator()
+    r.copy_thread = 0
+    r.table_state_notify = True
+    r.table_list = [state_table('public.a', 1, state='in-copy'),
+                    state_table('public.b', 0, dest_table='public.b2'),
+                    state_table('public.c', 1),
+                    state_table('public.d', 0)]
+    curs = QueryCursor({})
+    r.save_table_state(curs)
+    # everything in one execute
+    assert len(curs.sql) == 1
+    assert curs.sql[0].count('unnest') == 2
+    assert 'pg_notify' in curs.sql[0]
+    assert curs.args == [[['public.b'], ['public.b2'], 'set',
+                          'set', ['public.a', 'public.c'], [None, None], ['in-copy', 'ok'],
+                          londiste.playback.TABLE_STATE_CHANNEL, 'set']]
+    assert not any(t.changed for t in r.table_list)
+
+    # nothing changed, only dest_table override is stored
+    curs = QueryCursor({})
+    r.save_table_state(curs)
+    assert 'local_set_table_state' not in curs.sql[0]
+    assert 'pg_notify' not in curs.sql[0]
+
+    r.table_list = [state_table('public.d', 0)]
+    curs = QueryCursor({})
+    r.save_table_state(curs)
+    assert curs.sql == []
+
+
+def wait_validations(validator):
+    for fut in list(validator.running.values()):
+        fut.exception(timeout=5)
+
+
+def test_restore_fkeys_not_valid(monkeypatch):
+    validated = []
+    monkeypatch.setattr(londiste.fkey_validator, '_validate',
+                        lambda connstr, tbl, name: validated.append(name) or 0.5)
+    r = make_replicator(fkey_validate_workers=1, cf=SimpleNamespace(get=lambda opt: 'dbname=dst'))
+    fkeys = [{'from_table': 'public.a', 'to_table': 'public.b', 'fkey_name': 'a_fk',
+              'fkey_def': 'FOREIGN KEY (b_id) REFERENCES public.b(id)'},
+             {'from_table': 'public.c', 'to_table': 'public.b', 'fkey_name': 'c_fk',
+              'fkey_def': 'FOREIGN KEY (b_id) REFERENCES public.b(id) NOT VALID'}]
+    db = QueryDB(QueryCursor({}))
+    r.restore_fkeys_not_valid(db, fkeys)
+    sql = db.curs.sql
+    assert 'alter table only public.a add constraint a_fk FOREIGN KEY (b_id) REFERENCES public.b(id) NOT VALID' in sql
+    assert "comment on constraint a_fk on public.a is 'londiste.validate'" in sql
+    # fkey that was not valid on provider is not validated
+    assert 'alter table only public.c add constraint c_fk FOREIGN KEY (b_id) REFERENCES public.b(id) NOT VALID' in sql
+    assert not [q for q in sql if q.startswith('comment') and 'c_fk' in q]
+    assert len([q for q in sql if 'delete from londiste.pending_fkeys' in q]) == 2
+
+    wait_validations(r.fkey_validator)
+    r.restore_fkeys_not_valid(db, [])
+    assert validated == ['a_fk']
+    assert r.stat_dict == {'fkeys_validated': 1, 'fkeys_validating': 0}
+    r.fkey_validator.shutdown()
+
+
+def test_fkey_validate_retry(monkeypatch):
+    def fail(connstr, tbl, name):
+        raise ValueError('violates foreign key')
+    monkeypatch.setattr(londiste.fkey_validator, '_validate', fail)
+    validator = londiste.fkey_validator.FkeyValidator('dbname=dst', 1, logging.getLogger('test'))
+    validator.add('public.a', 'a_fk')
+    wait_validations(validator)
+    assert validator.poll() == (0, 1)
+    key = ('public.a', 'a_fk')
+    retry_time, count = validator.retry[key]
+    assert count == 1 and not validator.running
+    assert retry_time > time.time() + londiste.fkey_validator.RETRY_MIN_DELAY - 5
+
+    # retry time reached, queued again
+    validator.retry[key] = (0, count)
+    validator.poll()
+    assert key in validator.running
+    wait_validations(validator)
+    validator.poll()
+    assert validator.retry[key][1] == 2
+
+    monkeypatch.setattr(londiste.fkey_validator, '_validate', lambda connstr, tbl, name: 0.1)
+    validator.retry[key] = (0, 2)
+    validator.poll()
+    wait_validations(validator)
+    assert validator.poll() == (1, 0)
+    assert not validator.retry
+    validator.shutdown()
+
+
+def test_drop_marked_fkey():
+    fkey = {'from_table': 'public.a', 'to_table': 'public.b', 'fkey_name': 'a_fk'}
+    for marked in (True, False):
+        db = QueryDB(QueryCursor({'find_table_fkeys': [fkey],
+                                  'convalidated': [(1,)] if marked else []}))
+        make_replicator().drop_fkeys(db, 'public.a')
+        unmarked = [args for sql, args in zip(db.curs.sql, db.curs.args) if 'pending_fkeys' in sql]
+        # definition saved with NOT VALID is restored as fkey needing validation
+        assert unmarked == ([['public.a', 'a_fk']] if marked else [])
+
+
+def test_prepared_upsert():
+    r = make_replicator(prepared_statements=londiste.handler.PreparedStatementCache(10),
+                        replica_mode_enabled=False)
+    h = londiste.handler.TableHandler('public.t', {'prepared': '1', 'upsert': '1'}, None)
+    curs = RecordingCursor()
+    h.process_event(make_event('I', {'id': '1', 'v': 'a'}), r.apply_sql, curs)
+    h.process_event(make_event('U', {'id': '1', 'v': 'b'}), r.apply_sql, curs)
+    r.flush_sql(curs)
+    assert curs.sql == ["prepare londiste_stmt_1 as insert into public.t (id, v) values ($1, $2)"
+                        " on conflict (id) do update set v = excluded.v;\n"
+                        "execute londiste_stmt_1 ('1', 'a');\n"
+                        "execute londiste_stmt_1 ('1', 'b');"]
+
+
+def test_table_handler_kept():
+    r = make_state_replicator()
+    curs = QueryCursor({'from londiste.table_info': [('stamp1',)],
+                        'londiste.get_table_list': [table_row('public.t'), table_row('public.t2')]})
+    r.load_table_state(curs)
+    plugin = r.table_map['public.t'].plugin
+    plugin2 = r.table_map['public.t2'].plugin
+
+    # other table changed, handler instance is kept
+    curs.results['from londiste.table_info'] = [('stamp2',)]
+    curs.results['londiste.get_table_list'] = [
+        table_row('public.t'),
+        table_row('public.t2', table_attrs=db_urlencode({'handler': 'londiste(multirow=0)'}))]
+    r.load_table_state(curs)
+    assert r.table_map['public.t'].plugin is plugin
+    assert r.table_map['public.t2'].plugin is not plugin2
+    assert not r.table_map['public.t2'].plugin.conf.multirow
+
+    # new dest_table needs new handler
+    curs.results['from londiste.table_info'] = [('stamp3',)]
+    curs.results['londiste.get_table_list'][0] = table_row('public.t', dest_table='public.t_copy')
+    r.load_table_state(curs)
+    plugin = r.table_map['public.t'].plugin
+    assert plugin.dest_table == 'public.t_copy'
+
+    # dropped on reload
+    r.drop_table_handlers()
+    curs.results['from londiste.table_info'] = [('stamp4',)]
+    r.load_table_state(curs)
+    assert r.table_map['public.t'].plugin is not plugin
+
+
+class CopyCursor(QueryCursor):
+    """Cursor that reads COPY data."""
+
+    def __init__(self, results, encoding='UTF8'):
+        super().__init__(results)
+        self.connection = SimpleNamespace(encoding=encoding)
+        self.copies = []
+
+    def copy_expert(self, sql, f, size=8192):
+        self.copies.append((sql, f.read()))
+
+
+def test_bulk_binary_copy():
+    londiste.handler.BaseHandler.catalog_cache.clear()
+    h = londiste.handlers.bulk.BulkLoader('public.t', {'binary': '1'}, None)
+    types = {'pg_attribute': [('id', 'int4'), ('d', 'date'), ('p', 'point')]}
+    rows = [{'id': '1', 'd': '2024-01-31'}, {'id': '2', 'd': None}]
+    curs = CopyCursor(types)
+    h.copy_rows(curs, 'public.t', rows, ['id', 'd'])
+    sql, data = curs.copies[0]
+    assert sql == 'copy public.t (id,d) from stdin with (format binary)'
+    assert data.startswith(londiste.bincopy.COPY_HEADER)
+    # column types are looked up once per connection
+    h.copy_rows(curs, 'public.t', rows, ['id', 'd'])
+    assert len([q for q in curs.sql if 'pg_attribute' in q]) == 1
+    assert curs.copies[1] == curs.copies[0]
+
+    # value binary encoder does not handle
+    h.copy_rows(curs, 'public.t', [{'id': '3', 'd': '0044-03-15 BC'}], ['id', 'd'])
+    assert curs.copies[2] == ('COPY public.t (id,d) FROM STDIN', '3\t0044-03-15 BC\n')
+
+    # unsupported column type
+    h.copy_rows(curs, 'public.t', [{'id': '3', 'p': '(1,2)'}], ['id', 'p'])
+    assert curs.copies[3][0] == 'COPY public.t (id,p) FROM STDIN'
+
+    # new connection, not UTF8
+    curs = CopyCursor(types, encoding='LATIN1')
+    h.copy_rows(curs, 'public.t', rows, ['id', 'd'])
+    assert curs.copies[0][0] == 'COPY public.t (id,d) FROM STDIN'
+    assert [q for q in curs.sql if 'pg_attribute' in q]
@@ -0,0 +1,257 @@
+"""Binary COPY encoding.
+
+Encodes rows of text values, as decoded from events, into PostgreSQL
+binary COPY format, so server does not need to parse text.  Only
+types listed in ENCODERS are supported, values that cannot be encoded
+raise ValueError, then caller should use text COPY instead.
+
+>>> enc = BinaryCopyEncoder(['int4', 'text', 'numeric', 'timestamp'])
+>>> data = enc.encode([{'a': '1', 'b': 'x', 'c': '-12.50', 'd': '2000-01-01 00:00:01'}], ['a', 'b', 'c', 'd'])
+>>> data[:11] == COPY_HEADER[:11], len(data)
+(True, 64)
+>>> encode_numeric('-12.50')
+b'\\x00\\x02\\x00\\x00@\\x00\\x00\\x02\\x00\\x0c\\x13\\x88'
+>>> encode_timestamptz('2000-01-01 02:00:00+02')
+b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00'
+>>> encode_date('1999-12-31')
+b'\\xff\\xff\\xff\\xff'
+>>> BinaryCopyEncoder.supports(['int8', 'point'])
+False
+"""
+
+import datetime
+import re
+import struct
+
+from typing import Callable, Dict, List, Optional, Sequence
+
+__all__ = ['BinaryCopyEncoder', 'BufferReader', 'COPY_HEADER', 'ENCODERS']
+
+# signature, flags, header extension length
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+
+_int2 = struct.Struct('!h')
+_int4 = struct.Struct('!i')
+_int8 = struct.Struct('!q')
+_float4 = struct.Struct('!f')
+_float8 = struct.Struct('!d')
+_NULL = _int4.pack(-1)
+
+# days from 0001-01-01 to postgres epoch 2000-01-01
+_PG_EPOCH = datetime.date(2000, 1, 1).toordinal()
+_USECS_PER_DAY = 86400 * 1000000
+_DATE_INF = {'infinity': 0x7FFFFFFF, '-infinity': -0x80000000}
+_TS_INF = {'infinity': 0x7FFFFFFFFFFFFFFF, '-infinity': -0x8000000000000000}
+
+_rc_date = re.compile(r'^(\d{4})-(\d\d)-(\d\d)$')
+_rc_ts = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+                    r'(?:([-+])(\d\d)(?::?(\d\d))?(?::(\d\d))?)?$')
+_rc_numeric = re.compile(r'^([-+]?)(\d*)(?:\.(\d*))?$')
+
+# numeric sign word
+_NUMERIC_POS = 0x0000
+_NUMERIC_NEG = 0x4000
+_NUMERIC_SPECIAL = {'NaN': 0xC000, 'Infinity': 0xD000, '-Infinity': 0xF000}
+
+
+def encode_bool(val: str) -> bytes:
+    if val == 't':
+        return b'\x01'
+    if val == 'f':
+        return b'\x00'
+    raise ValueError('bad bool: %r' % val)
+
+
+def encode_int2(val: str) -> bytes:
+    return _int2.pack(int(val))
+
+
+def encode_int4(val: str) -> bytes:
+    return _int4.pack(int(val))
+
+
+def encode_int8(val: str) -> bytes:
+    return _int8.pack(int(val))
+
+
+def encode_float4(val: str) -> bytes:
+    return _float4.pack(float(val))
+
+
+def encode_float8(val: str) -> bytes:
+    return _float8.pack(float(val))
+
+
+def encode_text(val: str) -> bytes:
+    return val.encode('utf8')
+
+
+def encode_jsonb(val: str) -> bytes:
+    # format version
+    return b'\x01' + val.encode('utf8')
+
+
+def encode_bytea(val: str) -> bytes:
+    # only hex output format is supported
+    if not val.startswith('\\x'):
+        raise ValueError('bytea not in hex format')
+    return bytes.fromhex(val[2:])
+
+
+def encode_uuid(val: str) -> bytes:
+    res = bytes.fromhex(val.replace('-', ''))
+    if len(res) != 16:
+        raise ValueError('bad uuid: %r' % val)
+    return res
+
+
+def encode_date(val: str) -> bytes:
+    if val in _DATE_INF:
+        return _int4.pack(_DATE_INF[val])
+    m = _rc_date.match(val)
+    if not m:
+        raise ValueError('unsupported date: %r' % val)
+    y, mon, d = m.groups()
+    return _int4.pack(datetime.date(int(y), int(mon), int(d)).toordinal() - _PG_EPOCH)
+
+
+def _parse_timestamp(val: str, with_tz: bool) -> int:
+    """Return microseconds since postgres epoch, in UTC for timestamptz."""
+    m = _rc_ts.match(val)
+    if not m:
+        raise ValueError('unsupported timestamp: %r' % val)
+    y, mon, d, h, mi, s, frac, tzsign, tzh, tzm, tzs = m.groups()
+    if tzsign and not with_tz:
+        raise ValueError('unexpected time zone: %r' % val)
+    if with_tz and not tzsign:
+        raise ValueError('missing time zone: %r' % val)
+    days = datetime.date(int(y), int(mon), int(d)).toordinal() - _PG_EPOCH
+    secs = int(h) * 3600 + int(mi) * 60 + int(s)
+    if tzsign:
+        offset = int(tzh) * 3600 + int(tzm or 0) * 60 + int(tzs or 0)
+        secs = secs - offset if tzsign == '+' else secs + offset
+    usecs = int(frac.ljust(6, '0')) if frac else 0
+    return days * _USECS_PER_DAY + secs * 1000000 + usecs
+
+
+def encode_timestamp(val: str) -> bytes:
+    if val in _TS_INF:
+        return _int8.pack(_TS_INF[val])
+    return _int8.pack(_parse_timestamp(val, False))
+
+
+def encode_timestamptz(val: str) -> bytes:
+    if val in _TS_INF:
+        return _int8.pack(_TS_INF[val])
+    return _int8.pack(_parse_timestamp(val, True))
+
+
+def encode_numeric(val: str) -> bytes:
+    """Encode numeric as base-10000 digits."""
+    if val in _NUMERIC_SPECIAL:
+        return struct.pack('!hhHh', 0, 0, _NUMERIC_SPECIAL[val], 0)
+    m = _rc_numeric.match(val)
+    if not m or not (m.group(2) or m.group(3)):
+        raise ValueError('bad numeric: %r' % val)
+    sign, ipart, fpart = m.group(1), m.group(2).lstrip('0'), m.group(3) or ''
+    dscale = len(fpart)
+
+    # pad to full base-10000 digits
+    ipart = ipart.rjust((len(ipart) + 3) // 4 * 4, '0')
+    fpart = fpart.ljust((len(fpart) + 3) // 4 * 4, '0')
+    digits = [int(ipart[i:i + 4]) for i in range(0, len(ipart), 4)]
+    weight = len(digits) - 1
+    digits.extend(int(fpart[i:i + 4]) for i in range(0, len(fpart), 4))
+
+    # strip zero digits from both ends
+    while digits and digits[0] == 0:
+        digits.pop(0)
+        weight -= 1
+    while digits and digits[-1] == 0:
+        digits.pop()
+    if not digits:
+        weight = 0
+    sign_word = _NUMERIC_NEG if sign == '-' and digits else _NUMERIC_POS
+    return struct.pack('!hhHh%dh' % len(digits), len(digits), weight, sign_word, dscale, *digits)
+
+
+# type name -> encoder for text value
+ENCODERS: Dict[str, Callable[[str], bytes]] = {
+    'bool': encode_bool,
+    'int2': encode_int2,
+    'int4': encode_int4,
+    'int8': encode_int8,
+    'float4': encode_float4,
+    'float8': encode_float8,
+    'numeric': encode_numeric,
+    'text': encode_text,
+    'varchar': encode_text,
+    'bpchar': encode_text,
+    'name': encode_text,
+    'json': encode_text,
+    'jsonb': encode_jsonb,
+    'bytea': encode_bytea,
+    'uuid': encode_uuid,
+    'date': encode_date,
+    'timestamp': encode_timestamp,
+    'timestamptz': encode_timestamptz,
+}
+
+
+class BinaryCopyEncoder:
+    """Encodes rows for COPY .. WITH (FORMAT binary).
+
+    Encoders are given per column, in COPY column order.
+    Output buffer is reused between calls.
+    """
+
+    def __init__(self, type_names: Sequence[str]) -> None:
+        self.encoders = [ENCODERS[t] for t in type_names]
+        self.buf = bytearray()
+
+    @staticmethod
+    def supports(type_names: Sequence[str]) -> bool:
+        return all(t in ENCODERS for t in type_names)
+
+    def encode(self, rows: List[Dict[str, Optional[str]]], columns: Sequence[str]) -> bytearray:
+        """Return COPY data for rows, raises ValueError on bad value."""
+        buf = self.buf
+        del buf[:]
+        buf += COPY_HEADER
+        field_count = _int2.pack(len(columns))
+        cols = list(zip(columns, self.encoders))
+        try:
+            for row in rows:
+                buf += field_count
+                for col, enc in cols:
+                    val = row[col]
+                    if val is None:
+                        buf += _NULL
+                    else:
+                        data = enc(val)
+                        buf += _int4.pack(len(data))
+                        buf += data
+        except (struct.error, OverflowError) as ex:
+            # integer out of range
+            raise ValueError(str(ex))
+        buf += COPY_TRAILER
+        return buf
+
+
+class BufferReader:
+    """File-like reader over buffer, for copy_expert(), without copying it."""
+
+    def __init__(self, buf: bytearray) -> None:
+        self.view = memoryview(buf)
+        self.pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = len(self.view) - self.pos
+        res = self.view[self.pos:self.pos + size].tobytes()
+        self.pos += len(res)
+        return res
+
+    def close(self) -> None:
+        self.view.release()
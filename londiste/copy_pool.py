@@ -0,0 +1,107 @@
+"""Table copy scheduler.
+
+Runs table copies in pool of worker processes owned by main worker,
+instead of launching separate copy daemon for each table.  Pool
+processes are reused, so interpreter start-up and module imports
+happen once per pool process, not once per table.
+"""
+
+import multiprocessing
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Sequence, Tuple
+
+__all__ = ['CopyScheduler', 'run_copy']
+
+
+def run_copy(args: Sequence[str]) -> int:
+    """Copy one table, runs in pool process.
+
+    Returns exit code of copy script.
+    """
+    # playback imports this module
+    from londiste.table_copy import CopyTable
+
+    script = CopyTable(list(args))
+    try:
+        script.start()
+    except SystemExit as ex:
+        if ex.code is None:
+            return 0
+        if isinstance(ex.code, int):
+            return ex.code
+        return 1
+    return 0
+
+
+class CopyScheduler:
+    """Bounded pool of copy processes.
+
+    Keeps track of running copies per table, finished ones
+    are reported by poll().
+    """
+
+    def __init__(self, size: int, log) -> None:
+        self.size = size
+        self.log = log
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.running: Dict[str, Future] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                # fresh processes, without inherited db connections
+                ctx = multiprocessing.get_context('forkserver')
+                ctx.set_forkserver_preload(['londiste.table_copy'])
+            else:
+                ctx = multiprocessing.get_context('spawn')
+            self.pool = ProcessPoolExecutor(self.size, mp_context=ctx)
+        return self.pool
+
+    def is_running(self, table_name: str) -> bool:
+        return table_name in self.running
+
+    def submit(self, table_name: str, args: Sequence[str]) -> None:
+        """Queue copy of table."""
+        if table_name in self.running:
+            raise Exception("Copy of %s already running" % table_name)
+        self.running[table_name] = self._get_pool().submit(run_copy, list(args))
+
+    def poll(self) -> List[Tuple[str, str]]:
+        """Return (table_name, status) for copies finished since last call.
+
+        Status is 'ok', 'exit N' or 'failed: ERR'.
+        """
+        res = []
+        broken = False
+        for table_name, fut in list(self.running.items()):
+            if not fut.done():
+                continue
+            del self.running[table_name]
+            try:
+                code = fut.result()
+                status = 'ok' if code == 0 else 'exit %s' % code
+            except BrokenProcessPool as ex:
+                broken = True
+                status = 'failed: %s' % (ex or 'pool process died')
+            except BaseException as ex:
+                status = 'failed: %s' % ex
+            res.append((table_name, status))
+
+        # pool is unusable after process crash, start new one on next submit
+        if broken and self.pool is not None:
+            self.log.warning("Copy pool broken, restarting")
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        return res
+
+    def shutdown(self) -> None:
+        """Cancel queued copies, running ones finish on their own."""
+        for fut in self.running.values():
+            fut.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        self.running = {}
+
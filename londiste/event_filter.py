@@ -0,0 +1,261 @@
+"""Partial sync event filters.
+
+Filter config is YAML file given in event_filter_config_file::
+
+    public.mytable:
+       partialSync: true
+       partialConditionMaster: _tbl.id > 3
+       partialConditionSlave:  int(id) > 3
+
+partialConditionSlave is Python expression evaluated with row columns
+as variables.  It is compiled once, only plain expressions and small
+set of builtins are allowed.
+
+Tests:
+
+>>> f = EventFilter('public.mytable', "int(id) > 3 and name != 'x'")
+>>> f.check({'id': '4', 'name': 'y'})
+True
+>>> f.check({'id': '2', 'name': 'y'})
+False
+>>> EventFilter('public.mytable', "id.__class__")
+Traceback (most recent call last):
+    ...
+ValueError: Invalid event filter for public.mytable: name not allowed: __class__
+>>> EventFilter('public.mytable', "open('/etc/passwd')")
+Traceback (most recent call last):
+    ...
+ValueError: Invalid event filter for public.mytable: function not allowed: open
+
+Simple expressions can be pushed down to provider as SQL predicate
+on urlencoded ev_data.  The predicate may accept more events than
+the filter, never less:
+
+>>> EventFilter('public.t', "int(id) > 3").get_sql()
+"coalesce(substring(ev_data from '(?:^|&)id=(-?[0-9]+(?:[.][0-9]+)?)(?:&|$)')::numeric > 3, true)"
+>>> EventFilter('public.t', "kind in ('a', 'b') and not (name == 'x' or len(name) > 2)").get_sql()
+"(ev_data ~ '(^|&)kind=a(&|$)' or ev_data ~ '(^|&)kind=b(&|$)') and not (ev_data ~ '(^|&)name=x(&|$)')"
+>>> EventFilter('public.t', "len(name) > 2").get_sql() is None
+True
+"""
+
+import ast
+import json
+import re
+import sys
+
+from typing import Any, Dict, Optional
+
+import skytools
+
+__all__ = ['EventFilter', 'load_event_filters', 'parse_event_row', 'get_pushdown_filter']
+
+
+# builtins usable in filter expressions
+SAFE_BUILTINS = {
+    'abs': abs, 'all': all, 'any': any, 'bool': bool, 'float': float,
+    'int': int, 'len': len, 'max': max, 'min': min, 'round': round,
+    'set': set, 'str': str, 'tuple': tuple,
+}
+
+# allowed syntax nodes, anything else is rejected
+_SAFE_NODES = (
+    ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare,
+    ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant, ast.Attribute,
+    ast.Subscript, ast.Slice, ast.Tuple, ast.List, ast.Set,
+    ast.boolop, ast.operator, ast.unaryop, ast.cmpop,
+)
+if sys.version_info < (3, 9):
+    _SAFE_NODES += (ast.Index,)
+
+# names and values that look same in urlencoded form
+_RC_URLSAFE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+_SQL_CMP = {ast.Eq: '=', ast.NotEq: '<>', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+_FLIP_CMP = {ast.Eq: ast.Eq, ast.NotEq: ast.NotEq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+
+
+def parse_event_row(ev):
+    """Decode row data from urlenc or json event."""
+    if ev.data[0] == '{':
+        return json.loads(ev.data)
+    return skytools.db_urldecode(ev.data)
+
+
+class EventFilter:
+    """Compiled partialConditionSlave expression for one table."""
+
+    def __init__(self, table_name: str, expr: str) -> None:
+        self.table_name = table_name
+        self.expr = expr
+        try:
+            tree = ast.parse(expr.strip(), mode='eval')
+            self._check_tree(tree)
+        except (SyntaxError, ValueError) as ex:
+            raise ValueError("Invalid event filter for %s: %s" % (table_name, ex)) from None
+        self.code = compile(tree, '<filter %s>' % table_name, 'eval')
+        self.env = {'__builtins__': SAFE_BUILTINS}
+
+    def _check_tree(self, tree):
+        for node in ast.walk(tree):
+            if not isinstance(node, _SAFE_NODES):
+                raise ValueError("syntax not allowed: %s" % type(node).__name__)
+            if isinstance(node, ast.Name) and node.id.startswith('__'):
+                raise ValueError("name not allowed: %s" % node.id)
+            if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+                raise ValueError("name not allowed: %s" % node.attr)
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                    and node.func.id not in SAFE_BUILTINS:
+                raise ValueError("function not allowed: %s" % node.func.id)
+
+    def check(self, row: Dict[str, Any]) -> bool:
+        """Evaluate filter on decoded row."""
+        return eval(self.code, self.env, row)
+
+    def get_sql(self) -> Optional[str]:
+        """Translate filter to SQL predicate on ev_data.
+
+        Returns None if nothing useful can be translated.
+        """
+        tree = ast.parse(self.expr.strip(), mode='eval')
+        sql = _expr_sql(tree.body, True)
+        if sql == 'true':
+            return None
+        return sql
+
+
+def _column_ref(node):
+    """Return (kind, column) for col, str(col), int(col), float(col)."""
+    kind = 'str'
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id in ('str', 'int', 'float') and len(node.args) == 1 and not node.keywords:
+        kind = node.func.id
+        node = node.args[0]
+    if isinstance(node, ast.Name) and _RC_URLSAFE.match(node.id):
+        return kind, node.id
+    return None, None
+
+
+def _str_value_sql(col, val):
+    """Exact match for urlencoded value, None means NULL."""
+    if val is None:
+        rc = '(^|&)%s(&|$)' % col
+    else:
+        rc = '(^|&)%s=%s(&|$)' % (col, val.replace('.', '[.]'))
+    return "ev_data ~ %s" % skytools.quote_literal(rc)
+
+
+def _compare_sql(node):
+    """Return (sql, nullable) for single comparison or None."""
+    if len(node.ops) != 1:
+        return None
+    op = type(node.ops[0])
+    left, right = node.left, node.comparators[0]
+    kind, col = _column_ref(left)
+    if col is None and op in _FLIP_CMP:
+        kind, col = _column_ref(right)
+        left, right = right, left
+        op = _FLIP_CMP[op]
+    if col is None:
+        return None
+
+    if kind == 'str':
+        if op in (ast.In, ast.NotIn) and isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+            values = right.elts
+        elif op in (ast.Eq, ast.NotEq, ast.Is, ast.IsNot):
+            values = [right]
+        else:
+            return None
+        parts = []
+        for v in values:
+            if not isinstance(v, ast.Constant):
+                return None
+            if v.value is None:
+                parts.append(_str_value_sql(col, None))
+            elif isinstance(v.value, str) and _RC_URLSAFE.match(v.value) and op not in (ast.Is, ast.IsNot):
+                parts.append(_str_value_sql(col, v.value))
+            else:
+                return None
+        sql = " or ".join(parts)
+        if len(parts) > 1:
+            sql = "(%s)" % sql
+        if op in (ast.NotEq, ast.NotIn, ast.IsNot):
+            sql = "not %s" % sql
+        return sql, False
+
+    if op not in _SQL_CMP or not isinstance(right, ast.Constant) \
+            or isinstance(right.value, bool) or not isinstance(right.value, (int, float)):
+        return None
+    rc = '(?:^|&)%s=(-?[0-9]+(?:[.][0-9]+)?)(?:&|$)' % col
+    sql = "substring(ev_data from %s)::numeric %s %r" % (skytools.quote_literal(rc), _SQL_CMP[op], right.value)
+    return sql, True
+
+
+def _expr_sql(node, upper):
+    """Translate expression to SQL.
+
+    If upper is true, result is true for every row where expression may be true,
+    otherwise result is true only for rows where expression is surely true.
+    """
+    unknown = 'true' if upper else 'false'
+    if isinstance(node, ast.BoolOp):
+        parts = [_expr_sql(v, upper) for v in node.values]
+        if isinstance(node.op, ast.And):
+            if 'false' in parts:
+                return 'false'
+            parts = [p for p in parts if p != 'true']
+            if not parts:
+                return 'true'
+            return " and ".join(parts)
+        if 'true' in parts:
+            return 'true'
+        parts = [p for p in parts if p != 'false']
+        if not parts:
+            return 'false'
+        if len(parts) == 1:
+            return parts[0]
+        return "(%s)" % " or ".join(parts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        sql = _expr_sql(node.operand, not upper)
+        if sql in ('true', 'false'):
+            return 'false' if sql == 'true' else 'true'
+        return "not (%s)" % sql
+    if isinstance(node, ast.Compare):
+        res = _compare_sql(node)
+        if res:
+            sql, nullable = res
+            if nullable:
+                return "coalesce(%s, %s)" % (sql, unknown)
+            return sql
+    return unknown
+
+
+def load_event_filters(event_filter_config):
+    """Compile filters for tables with partialSync enabled."""
+    filters = {}
+    for table_name, event_filter in (event_filter_config or {}).items():
+        if event_filter and event_filter.get('partialSync'):
+            filters[table_name] = EventFilter(table_name, event_filter['partialConditionSlave'])
+    return filters
+
+
+def get_pushdown_filter(filters):
+    """Build consumer filter from translatable event filters.
+
+    Only urlencoded data events of filtered tables are affected.
+
+    >>> print(get_pushdown_filter({'public.t': EventFilter('public.t', "kind == 'a'"),
+    ...                            'public.u': EventFilter('public.u', "len(name) > 2")}))
+    (ev_extra1 is distinct from 'public.t' or ev_type !~ '^[IUD]:' or ev_data ~ '(^|&)kind=a(&|$)')
+    >>> get_pushdown_filter({'public.u': EventFilter('public.u', "len(name) > 2")}) is None
+    True
+    """
+    parts = []
+    for table_name, event_filter in sorted(filters.items()):
+        sql = event_filter.get_sql()
+        if sql:
+            parts.append("(ev_extra1 is distinct from %s or ev_type !~ '^[IUD]:' or %s)" % (
+                skytools.quote_literal(table_name), sql))
+    if not parts:
+        return None
+    return " and ".join(parts)
@@ -0,0 +1,160 @@
+"""Background validation of foreign keys.
+
+Foreign keys are restored as NOT VALID, which needs only short lock
+and no scan.  VALIDATE CONSTRAINT runs later on separate connections,
+it does not block writes to the tables, so replay can continue.
+
+Fkeys waiting for validation are marked with constraint comment,
+so validation continues after restart.  When marked fkey is dropped
+again, NOT VALID is removed from its pending definition, so it is
+restored as fkey that needs validation.  Failed validations are
+retried with increasing delay.
+"""
+
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import skytools
+
+__all__ = ['FkeyValidator', 'is_marked', 'unmark_pending']
+
+# comment on constraints waiting for validation
+VALIDATE_MARK = 'londiste.validate'
+
+# fkeys marked for validation
+UNVALIDATED_FKEYS_SQL = """
+select n.nspname || '.' || r.relname as from_table, c.conname as fkey_name
+  from pg_catalog.pg_constraint c
+  join pg_catalog.pg_class r on (r.oid = c.conrelid)
+  join pg_catalog.pg_namespace n on (n.oid = r.relnamespace)
+ where c.contype = 'f'
+   and not c.convalidated
+   and pg_catalog.obj_description(c.oid, 'pg_constraint') = %s
+"""
+
+# is fkey marked for validation
+MARKED_FKEY_SQL = """
+select 1 from pg_catalog.pg_constraint c
+ where c.conrelid = pg_catalog.to_regclass(%s)
+   and c.conname = %s
+   and c.contype = 'f'
+   and not c.convalidated
+   and pg_catalog.obj_description(c.oid, 'pg_constraint') = %s
+"""
+
+# dropped fkey is pending with NOT VALID in definition
+UNMARK_PENDING_SQL = r"""
+update londiste.pending_fkeys
+   set fkey_def = regexp_replace(fkey_def, '\s+NOT VALID$', '', 'i')
+ where from_table = %s and fkey_name = %s
+"""
+
+# delay before retrying failed validation, doubles on each failure
+RETRY_MIN_DELAY = 60
+RETRY_MAX_DELAY = 3600
+
+
+def is_marked(curs, from_table: str, fkey_name: str) -> bool:
+    """Is fkey waiting for validation."""
+    curs.execute(MARKED_FKEY_SQL, [skytools.quote_fqident(from_table), fkey_name, VALIDATE_MARK])
+    return curs.fetchone() is not None
+
+
+def unmark_pending(curs, from_table: str, fkey_name: str) -> None:
+    """Make dropped fkey restore as one that needs validation."""
+    curs.execute(UNMARK_PENDING_SQL, [from_table, fkey_name])
+
+
+def _validate(connstr: str, from_table: str, fkey_name: str) -> Optional[float]:
+    """Run VALIDATE CONSTRAINT, returns duration.
+
+    Returns None if fkey is not waiting for validation anymore.
+    """
+    start = time.time()
+    db = skytools.connect_database(connstr)
+    try:
+        curs = db.cursor()
+        if not is_marked(curs, from_table, fkey_name):
+            return None
+        qtbl = skytools.quote_fqident(from_table)
+        qname = skytools.quote_ident(fkey_name)
+        curs.execute("alter table only %s validate constraint %s" % (qtbl, qname))
+        curs.execute("comment on constraint %s on %s is null" % (qname, qtbl))
+        db.commit()
+    finally:
+        db.close()
+    return time.time() - start
+
+
+class FkeyValidator:
+    """Validates NOT VALID fkeys in thread pool."""
+
+    def __init__(self, connstr: str, workers: int, log) -> None:
+        self.connstr = connstr
+        self.log = log
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='fkey-validate')
+        self.running: Dict[Tuple[str, str], Future] = {}
+        # failed validations: key -> (retry time, failure count)
+        self.retry: Dict[Tuple[str, str], Tuple[float, int]] = {}
+
+    def add(self, from_table: str, fkey_name: str) -> None:
+        """Queue validation, unless already queued."""
+        key = (from_table, fkey_name)
+        if key not in self.running:
+            self.log.info('Validating fkey in background: %s.%s', from_table, fkey_name)
+            self.running[key] = self.pool.submit(_validate, self.connstr, from_table, fkey_name)
+
+    def mark(self, curs, from_table: str, fkey_name: str) -> None:
+        """Remember in db that fkey needs validation."""
+        q = "comment on constraint %s on %s is %s" % (
+            skytools.quote_ident(fkey_name), skytools.quote_fqident(from_table),
+            skytools.quote_literal(VALIDATE_MARK))
+        curs.execute(q)
+
+    def add_unvalidated(self, curs) -> None:
+        """Queue marked fkeys left not validated by previous run."""
+        curs.execute(UNVALIDATED_FKEYS_SQL, [VALIDATE_MARK])
+        for row in curs.fetchall():
+            self.add(row['from_table'], row['fkey_name'])
+
+    def poll(self) -> Tuple[int, int]:
+        """Log finished validations, return (finished ok, failed) counts.
+
+        Failed validations are queued again when their retry time comes.
+        """
+        ok = failed = 0
+        now = time.time()
+        for key, fut in list(self.running.items()):
+            if not fut.done():
+                continue
+            del self.running[key]
+            try:
+                secs = fut.result()
+            except Exception as ex:
+                count = self.retry.get(key, (0, 0))[1] + 1
+                delay = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** (count - 1))
+                self.retry[key] = (now + delay, count)
+                self.log.error('Fkey validation failed: %s.%s: %s, retrying in %d s', key[0], key[1], ex, delay)
+                failed += 1
+                continue
+            self.retry.pop(key, None)
+            if secs is None:
+                self.log.info('Fkey does not need validation anymore: %s.%s', key[0], key[1])
+            else:
+                self.log.info('Fkey validated: %s.%s (%.1f s)', key[0], key[1], secs)
+                ok += 1
+
+        for key, (retry_time, _) in list(self.retry.items()):
+            if retry_time <= now and key not in self.running:
+                self.add(key[0], key[1])
+        return ok, failed
+
+    def shutdown(self) -> None:
+        """Drop queued validations, running ones finish in background."""
+        for fut in self.running.values():
+            fut.cancel()
+        self.pool.shutdown(wait=False)
+        self.running = {}
+        self.retry = {}
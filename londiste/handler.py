@@ -4,12 +4,14 @@
 Per-table decision how to create trigger, copy data and apply events.
 """
 
-from typing import List, Dict, Any, Sequence, Tuple, Optional
+from typing import Callable, List, Dict, Any, Sequence, Tuple, Optional
 
 import json
 import logging
 import sys
 
+from collections import OrderedDict
+
 import skytools
 from skytools.basetypes import Cursor
 
@@ -43,7 +45,7 @@ plain londiste:
 
 """
 
-__all__ = ['RowCache', 'BaseHandler', 'build_handler', 'EncodingValidator',
+__all__ = ['RowCache', 'RowBatch', 'PreparedStatementCache', 'BaseHandler', 'build_handler', 'EncodingValidator',
            'load_handler_modules', 'create_handler_string']
 
 
@@ -81,12 +83,307 @@ class RowCache:
         skytools.magic_insert(curs, self.table_name, self.rows, fields)
 
 
+class RowBatch:
+    """Consecutive row changes that can be applied with one statement.
+
+    Handler queues batch with single row, replay loop merges it into
+    previous one if table, operation and column set match.  Rows
+    are kept in event order.
+
+    With upsert, inserts and updates are both given as op 'I' and
+    applied with INSERT .. ON CONFLICT (pkey) DO UPDATE.
+
+    Typed NULL row in VALUES fixes column types, as all values
+    are given as text literals:
+
+    >>> b = RowBatch('U', 'public.t', ['id'], {'id': '1', 'val': 'a'})
+    >>> b.merge(RowBatch('U', 'public.t', ['id'], {'id': '2', 'val': None}))
+    True
+    >>> print(b.get_sql())
+    update only public.t as dst set val = src.val from (values ((null::public.t).id, (null::public.t).val),
+     ('1', 'a'),
+     ('2', null)) as src (id, val) where dst.id = src.id;
+
+    Repeated pkey starts new statement:
+
+    >>> b.merge(RowBatch('U', 'public.t', ['id'], {'id': '1', 'val': 'c'}))
+    False
+    >>> u = RowBatch('I', 'public.t', ['id'], {'id': '1', 'val': 'a'}, upsert=True)
+    >>> u.merge(RowBatch('I', 'public.t', ['id'], {'id': '1', 'val': 'b'}, upsert=True))
+    False
+    >>> u.merge(RowBatch('I', 'public.t', ['id'], {'id': '2', 'val': 'b'}, upsert=True))
+    True
+    >>> print(u.get_sql())
+    insert into public.t (id, val) values ('1', 'a'),
+     ('2', 'b') on conflict (id) do update set val = excluded.val;
+
+    Updates and deletes need pkeys, as without merging:
+
+    >>> RowBatch('D', 'public.t', [], {'id': '1'}).merge(RowBatch('D', 'public.t', [], {'id': '2'}))
+    Traceback (most recent call last):
+    ...
+    Exception: delete needs pkeys
+
+    Prepared batches are not merged:
+
+    >>> p = RowBatch('D', 'public.t', ['id'], {'id': '1', 'val': 'a'}, prepared=True)
+    >>> p.merge(RowBatch('D', 'public.t', ['id'], {'id': '2', 'val': 'a'}, prepared=True))
+    False
+    >>> p.get_prepare_info()
+    (('public.t', 'D', ('id',)), 'delete from only public.t where id = $1;', ('id',))
+    """
+
+    __slots__ = ('op', 'table_name', 'pkeys', 'fields', 'rows', 'pkey_set', 'prepared',
+                 'upsert', 'multirow')
+
+    def __init__(self, op: str, table_name: str, pkeys: Sequence[str], row: Dict[str, Any],
+                 prepared: bool = False, upsert: bool = False, multirow: bool = True) -> None:
+        self.op = op
+        self.table_name = table_name
+        self.pkeys = tuple(pkeys)
+        self.fields = tuple(row.keys())
+        self.rows = [row]
+        self.pkey_set = None
+        self.prepared = prepared
+        self.upsert = upsert
+        self.multirow = multirow and not prepared
+
+    def _pkey_value(self, row):
+        return tuple(row[k] for k in self.pkeys)
+
+    def _check_pkeys(self):
+        if not self.pkeys:
+            if self.upsert:
+                raise Exception("upsert needs pkeys")
+            if self.op == 'U':
+                raise Exception("update needs pkeys")
+            if self.op == 'D':
+                raise Exception("delete needs pkeys")
+
+    def merge(self, other: "RowBatch") -> bool:
+        """Add rows from other batch, if possible."""
+        if other.op != self.op or other.table_name != self.table_name \
+                or other.pkeys != self.pkeys or other.fields != self.fields \
+                or other.upsert != self.upsert or not self.multirow or not other.multirow:
+            return False
+        self._check_pkeys()
+        if self.op == 'U' or self.upsert:
+            # update ... from values may apply only one of the duplicate
+            # rows and on conflict cannot update row twice, so same key
+            # must go to next statement
+            if self.pkey_set is None:
+                self.pkey_set = set(self._pkey_value(r) for r in self.rows)
+            for row in other.rows:
+                if self._pkey_value(row) in self.pkey_set:
+                    return False
+            for row in other.rows:
+                self.pkey_set.add(self._pkey_value(row))
+        self.rows.extend(other.rows)
+        return True
+
+    def _upsert_sql(self, fields):
+        """Return ON CONFLICT clause for fields."""
+        pkeys = ", ".join(skytools.quote_ident(k) for k in self.pkeys)
+        setcols = [f for f in fields if f not in self.pkeys]
+        if not setcols:
+            return " on conflict (%s) do nothing" % pkeys
+        sets = ", ".join("%s = excluded.%s" % (skytools.quote_ident(f), skytools.quote_ident(f)) for f in setcols)
+        return " on conflict (%s) do update set %s" % (pkeys, sets)
+
+    def get_size(self) -> int:
+        """Approximate size of row data in bytes."""
+        return sum(len(v) if isinstance(v, str) else 8
+                   for row in self.rows for v in row.values())
+
+    def _values(self, fields, typed):
+        """Render VALUES list, optionally with typed NULL row first."""
+        fqname = skytools.quote_fqident(self.table_name)
+        lines = []
+        if typed:
+            # fixes column types, never matches
+            lines.append(", ".join("(null::%s).%s" % (fqname, skytools.quote_ident(f)) for f in fields))
+        for row in self.rows:
+            lines.append(", ".join(skytools.quote_literal(row[f]) for f in fields))
+        return "(" + "),\n (".join(lines) + ")"
+
+    def get_sql(self) -> str:
+        """Render statement for all rows."""
+        tbl = self.table_name
+        pkeys = self.pkeys
+        self._check_pkeys()
+        if self.upsert and self.op == 'I':
+            cols = ", ".join(skytools.quote_ident(f) for f in self.fields)
+            return "insert into %s (%s) values %s%s;" % (
+                skytools.quote_fqident(tbl), cols, self._values(self.fields, False), self._upsert_sql(self.fields))
+        if len(self.rows) == 1:
+            row = self.rows[0]
+            if self.op == 'I':
+                return skytools.mk_insert_sql(row, tbl, pkeys)
+            elif self.op == 'U':
+                return skytools.mk_update_sql(row, tbl, pkeys)
+            return skytools.mk_delete_sql(row, tbl, pkeys)
+
+        fqname = skytools.quote_fqident(tbl)
+        if self.op == 'I':
+            cols = ", ".join(skytools.quote_ident(f) for f in self.fields)
+            return "insert into %s (%s) values %s;" % (fqname, cols, self._values(self.fields, False))
+
+        whe = " and ".join("dst.%s = src.%s" % (skytools.quote_ident(k), skytools.quote_ident(k)) for k in pkeys)
+        if self.op == 'D':
+            cols = ", ".join(skytools.quote_ident(k) for k in pkeys)
+            return "delete from only %s as dst using (values %s) as src (%s) where %s;" % (
+                fqname, self._values(pkeys, True), cols, whe)
+
+        setcols = [f for f in self.fields if f not in pkeys]
+        if not setcols:
+            return "\n".join(skytools.mk_update_sql(row, tbl, pkeys) for row in self.rows)
+        fields = pkeys + tuple(setcols)
+        cols = ", ".join(skytools.quote_ident(f) for f in fields)
+        sets = ", ".join("%s = src.%s" % (skytools.quote_ident(f), skytools.quote_ident(f)) for f in setcols)
+        return "update only %s as dst set %s from (values %s) as src (%s) where %s;" % (
+            fqname, sets, self._values(fields, True), cols, whe)
+
+    def get_prepare_info(self) -> Optional[Tuple[Tuple[Any, ...], str, Tuple[str, ...]]]:
+        """Return (key, parametrized statement, param fields) or None
+        if statement cannot be prepared.
+        """
+        fqname = skytools.quote_fqident(self.table_name)
+        pkeys = self.pkeys
+        self._check_pkeys()
+        if self.op == 'I':
+            params = self.fields
+            cols = ", ".join(skytools.quote_ident(f) for f in params)
+            args = ", ".join("$%d" % (i + 1) for i in range(len(params)))
+            upsert = self._upsert_sql(params) if self.upsert else ""
+            stmt = "insert into %s (%s) values (%s)%s;" % (fqname, cols, args, upsert)
+        elif self.op == 'U':
+            setcols = tuple(f for f in self.fields if f not in pkeys)
+            if not setcols:
+                return None
+            params = setcols + pkeys
+            sets = ", ".join("%s = $%d" % (skytools.quote_ident(f), i + 1) for i, f in enumerate(setcols))
+            whe = " and ".join("%s = $%d" % (skytools.quote_ident(k), len(setcols) + i + 1)
+                               for i, k in enumerate(pkeys))
+            stmt = "update only %s set %s where %s;" % (fqname, sets, whe)
+        else:
+            params = pkeys
+            whe = " and ".join("%s = $%d" % (skytools.quote_ident(k), i + 1) for i, k in enumerate(pkeys))
+            stmt = "delete from only %s where %s;" % (fqname, whe)
+        return ((self.table_name, self.op, params), stmt, params)
+
+
+class PreparedStatementCache:
+    """Server-side prepared statements for RowBatch statements.
+
+    Statements are tracked per connection, keyed by table, operation and
+    column list.  Least recently used statements are deallocated
+    when cache is full.  Returned SQL contains PREPARE/DEALLOCATE
+    commands inline, so it must be executed in given order.
+
+    >>> cache = PreparedStatementCache(1)
+    >>> print(cache.get_sql(RowBatch('I', 'public.t', ['id'], {'id': '1', 'val': 'a'}, prepared=True)))
+    prepare londiste_stmt_1 as insert into public.t (id, val) values ($1, $2);
+    execute londiste_stmt_1 ('1', 'a');
+    >>> print(cache.get_sql(RowBatch('D', 'public.t', ['id'], {'id': '1'}, prepared=True)))
+    deallocate londiste_stmt_1;
+    prepare londiste_stmt_2 as delete from only public.t where id = $1;
+    execute londiste_stmt_2 ('1');
+    """
+
+    def __init__(self, size: int) -> None:
+        if size < 1:
+            raise ValueError("Bad prepared statement cache size: %d" % size)
+        self.size = size
+        self.stmt_map: "OrderedDict[Tuple[Any, ...], str]" = OrderedDict()
+        self.stmt_count = 0
+
+    def get_sql(self, batch: RowBatch) -> str:
+        """Render batch as EXECUTE of prepared statement."""
+        info = batch.get_prepare_info()
+        if info is None:
+            return batch.get_sql()
+        key, stmt, params = info
+
+        sql_list = []
+        name = self.stmt_map.get(key)
+        if name:
+            self.stmt_map.move_to_end(key)
+        else:
+            if len(self.stmt_map) >= self.size:
+                _, old_name = self.stmt_map.popitem(last=False)
+                sql_list.append("deallocate %s;" % old_name)
+            self.stmt_count += 1
+            name = "londiste_stmt_%d" % self.stmt_count
+            self.stmt_map[key] = name
+            sql_list.append("prepare %s as %s" % (name, stmt))
+
+        for row in batch.rows:
+            vals = ", ".join(skytools.quote_literal(row[f]) for f in params)
+            sql_list.append("execute %s (%s);" % (name, vals))
+        return "\n".join(sql_list)
+
+    def clear(self, curs: Optional[Cursor] = None) -> None:
+        """Forget all statements, deallocate them if cursor is given."""
+        if curs is not None and self.stmt_map:
+            curs.execute("deallocate all")
+        self.stmt_map.clear()
+
+
+class CatalogCache:
+    """Catalog facts about destination connection, kept across batches.
+
+    Values are computed on first use.  Cache is cleared when cursor
+    of other connection is given, and by replay loop on reconnect,
+    rollback and EXECUTE events.
+    """
+
+    def __init__(self) -> None:
+        self.conn: Any = None
+        self.data: Dict[Tuple[Any, ...], Any] = {}
+
+    def _check_conn(self, curs: Cursor) -> None:
+        if curs.connection is not self.conn:
+            self.data = {}
+            self.conn = curs.connection
+
+    def get(self, curs: Cursor, key: Tuple[Any, ...], func: Callable[[Cursor], Any]) -> Any:
+        """Return cached value, call func(curs) to fill it."""
+        self._check_conn(curs)
+        try:
+            return self.data[key]
+        except KeyError:
+            val = self.data[key] = func(curs)
+            return val
+
+    def set(self, curs: Cursor, key: Tuple[Any, ...], val: Any) -> None:
+        self._check_conn(curs)
+        self.data[key] = val
+
+    def clear(self) -> None:
+        self.conn = None
+        self.data = {}
+
+
+# parsed Parameters: section of docstring, per handler class
+_doc_args_cache: Dict[type, List[Tuple[str, str, str]]] = {}
+
+
 class BaseHandler:
     """Defines base API, does nothing.
     """
     handler_name = 'nop'
     log = logging.getLogger('basehandler')
 
+    # (event, row) decoded earlier by replay loop
+    parsed_row: Optional[Tuple[Any, Dict[str, Any]]] = None
+
+    # shared by all handlers
+    catalog_cache = CatalogCache()
+
+    # call flush_pending() after each event when batch is retried,
+    # only cheap for handlers that turn held rows into queued statements
+    flush_on_retry = False
+
     def __init__(self, table_name, args, dest_table):
         self.table_name = table_name
         self.dest_table = dest_table or table_name
@@ -121,7 +418,9 @@ class BaseHandler:
     def _check_args(self, args):
         self.valid_arg_names = []
         passed_arg_names = args.keys() if args else []
-        args_from_doc = self._parse_args_from_doc()
+        args_from_doc = _doc_args_cache.get(type(self))
+        if args_from_doc is None:
+            args_from_doc = _doc_args_cache[type(self)] = self._parse_args_from_doc()
         if args_from_doc:
             self.valid_arg_names = [arg[0] for arg in args_from_doc]
         invalid = set(passed_arg_names) - set(self.valid_arg_names)
@@ -169,6 +468,26 @@ class BaseHandler:
         """Called when batch finishes."""
         pass
 
+    def flush_pending(self, dst_curs):
+        """Apply or queue rows held back until end of batch.
+
+        Called before TRUNCATE and EXECUTE events, and after each event
+        when batch is retried after error if flush_on_retry is set.
+        """
+        pass
+
+    def set_parsed_row(self, ev, row):
+        """Give already decoded row data for next process_event() call."""
+        self.parsed_row = (ev, row)
+
+    def pop_parsed_row(self, ev):
+        """Return row data decoded earlier for this event or None."""
+        parsed = self.parsed_row
+        self.parsed_row = None
+        if parsed and parsed[0] is ev:
+            return parsed[1]
+        return None
+
     def get_copy_condition(self, src_curs, dst_curs):
         """ Use if you want to filter data """
         return ''
@@ -219,6 +538,10 @@ class BaseHandler:
         """Get event copy for destination queue."""
         return ev
 
+    def rewrites_copy_event(self) -> bool:
+        """Whether get_copy_event() may change or drop events."""
+        return type(self).get_copy_event is not BaseHandler.get_copy_event
+
 
 class TableHandler(BaseHandler):
     """Default Londiste handler, inserts events into tables with plain SQL.
@@ -227,6 +550,14 @@ class TableHandler(BaseHandler):
       encoding=ENC - Validate and fix incoming data from encoding.
                      Only 'utf8' is supported at the moment.
       ignore_truncate=BOOL - Ignore truncate event. Default: 0; Values: 0,1.
+      multirow=BOOL - Merge consecutive row events for same table, operation
+                      and columns into multi-row statements. Default: 0; Values: 0,1.
+      prepared=BOOL - Apply row events via server-side prepared statements.
+                      Cannot be combined with multirow. Default: 0; Values: 0,1.
+      upsert=BOOL - Apply inserts and updates as INSERT .. ON CONFLICT (pkey) DO UPDATE,
+                    so replaying events again is safe. Default: 0; Values: 0,1.
+      coalesce=BOOL - Keep only net change per primary key, applied at end of batch
+                      as deletes, updates, inserts. Default: 0; Values: 0,1.
     """
     handler_name = 'londiste'
 
@@ -238,6 +569,9 @@ class TableHandler(BaseHandler):
 
     allow_sql_event = 1
 
+    # coalesced rows are queued per event, so failing one is found
+    flush_on_retry = True
+
     def __init__(self, table_name, args, dest_table):
         super().__init__(table_name, args, dest_table)
 
@@ -247,9 +581,23 @@ class TableHandler(BaseHandler):
         else:
             self.encoding_validator = None
 
+        # (pklist, pk values) -> [existed_before, last_op, row]
+        self.coalesce_map = {}
+        self.coalesce_queue = None
+
+    def reset(self):
+        self.coalesce_map = {}
+        super().reset()
+
     def get_config(self):
         conf = super().get_config()
         conf.ignore_truncate = self.get_arg('ignore_truncate', [0, 1], 0)
+        conf.multirow = self.get_arg('multirow', [0, 1], 0)
+        conf.prepared = self.get_arg('prepared', [0, 1], 0)
+        if conf.multirow and conf.prepared:
+            raise Exception('Handler arguments multirow and prepared cannot be used together')
+        conf.upsert = self.get_arg('upsert', [0, 1], 0)
+        conf.coalesce = self.get_arg('coalesce', [0, 1], 0)
         return conf
 
     def process_event(self, ev, sql_queue_func, arg):
@@ -259,6 +607,8 @@ class TableHandler(BaseHandler):
             fqname = self.fq_dest_table
             fmt = self.sql_command[ev.type]
             sql = fmt % (fqname, row)
+            # keep order with collected rows
+            self.flush_coalesced()
         else:
             if ev.type[0] == '{':
                 jtype = json.loads(ev.type)
@@ -268,16 +618,106 @@ class TableHandler(BaseHandler):
                 # urlenc event
                 pklist = ev.type[2:].split(',')
                 op = ev.type[0]
-            tbl = self.dest_table
-            if op == 'I':
-                sql = skytools.mk_insert_sql(row, tbl, pklist)
-            elif op == 'U':
-                sql = skytools.mk_update_sql(row, tbl, pklist)
-            elif op == 'D':
-                sql = skytools.mk_delete_sql(row, tbl, pklist)
+            if self.conf.coalesce:
+                self.coalesce_row(op, pklist, row)
+                self.coalesce_queue = (sql_queue_func, arg)
+                return
+            sql = self.mk_row_sql(op, pklist, row)
 
         sql_queue_func(sql, arg)
 
+    def mk_row_sql(self, op, pklist, row):
+        """Statement for one row event.
+
+        With upsert, updates are applied as inserts too:
+
+        >>> h = TableHandler('public.t', {'upsert': '1'}, None)
+        >>> print(h.mk_row_sql('U', ['id'], {'id': '1', 'v': 'a'}).get_sql())
+        insert into public.t (id, v) values ('1', 'a') on conflict (id) do update set v = excluded.v;
+        >>> print(h.mk_row_sql('I', ['id'], {'id': '1'}).get_sql())
+        insert into public.t (id) values ('1') on conflict (id) do nothing;
+        >>> print(h.mk_row_sql('D', ['id'], {'id': '1', 'v': 'a'}).get_sql())
+        delete from only public.t where id = '1';
+        >>> h.mk_row_sql('I', [], {'id': '1'})
+        Traceback (most recent call last):
+        ...
+        Exception: upsert needs primary key: public.t
+        """
+        tbl = self.dest_table
+        if self.conf.upsert:
+            if not pklist:
+                raise Exception('upsert needs primary key: %s' % self.table_name)
+            if op == 'U':
+                op = 'I'
+            return RowBatch(op, tbl, pklist, row, prepared=self.conf.prepared,
+                            upsert=True, multirow=self.conf.multirow)
+        if self.conf.multirow or self.conf.prepared:
+            return RowBatch(op, tbl, pklist, row, prepared=self.conf.prepared)
+        elif op == 'I':
+            return skytools.mk_insert_sql(row, tbl, pklist)
+        elif op == 'U':
+            return skytools.mk_update_sql(row, tbl, pklist)
+        elif op == 'D':
+            return skytools.mk_delete_sql(row, tbl, pklist)
+        raise Exception('Unknown event type: %s' % op)
+
+    def coalesce_row(self, op, pklist, row):
+        """Remember net state of row."""
+        if op not in 'IUD':
+            raise Exception('Unknown event type: %s' % op)
+        if not pklist:
+            raise Exception('coalesce needs primary key: %s' % self.table_name)
+        key = (tuple(pklist), tuple(row[k] for k in pklist))
+        state = self.coalesce_map.get(key)
+        if state is None:
+            self.coalesce_map[key] = [op != 'I', op, row]
+        else:
+            state[1] = op
+            state[2] = row
+
+    def flush_coalesced(self):
+        """Queue net changes of collected rows.
+
+        I+U+U -> I, I+D -> nothing, U+D -> D, D+I -> U.
+        Deletes go first, then updates and inserts, each in order
+        of first event for the key.
+
+        >>> h = TableHandler('public.t', {'coalesce': '1'}, None)
+        >>> h.coalesce_queue = (lambda sql, arg: print(sql), None)
+        >>> for op, key, val in [('I', '1', 'a'), ('U', '2', 'b'), ('D', '5', None), ('D', '3', None),
+        ...                      ('U', '1', 'c'), ('I', '4', 'd'), ('D', '4', 'd'), ('D', '2', 'b'),
+        ...                      ('I', '3', 'e')]:
+        ...     h.coalesce_row(op, ['id'], {'id': key, 'v': val})
+        >>> h.flush_coalesced()
+        delete from only public.t where id = '2';
+        delete from only public.t where id = '5';
+        update only public.t set v = 'e' where id = '3';
+        insert into public.t (id, v) values ('1', 'c');
+        """
+        if not self.coalesce_map:
+            return
+        ops = {'D': [], 'U': [], 'I': []}
+        for (pklist, _), (existed, last_op, row) in self.coalesce_map.items():
+            exists = last_op != 'D'
+            if existed and exists:
+                ops['U'].append((pklist, row))
+            elif existed:
+                ops['D'].append((pklist, row))
+            elif exists:
+                ops['I'].append((pklist, row))
+        self.coalesce_map = {}
+
+        sql_queue_func, arg = self.coalesce_queue
+        for op in 'DUI':
+            for pklist, row in ops[op]:
+                sql_queue_func(self.mk_row_sql(op, list(pklist), row), arg)
+
+    def finish_batch(self, batch_info, dst_curs):
+        self.flush_coalesced()
+
+    def flush_pending(self, dst_curs):
+        self.flush_coalesced()
+
     def parse_row_data(self, ev):
         """Extract row data from event, with optional encoding fixes.
 
@@ -291,11 +731,15 @@ class TableHandler(BaseHandler):
                 return self.encoding_validator.validate_string(ev.data, self.table_name)
             return ev.data
         elif ev.data[0] == '{':
-            row = json.loads(ev.data)
+            row = self.pop_parsed_row(ev)
+            if row is None:
+                row = json.loads(ev.data)
             # FIXME: encoding_validator?
             return row
         else:
-            row = skytools.db_urldecode(ev.data)
+            row = self.pop_parsed_row(ev)
+            if row is None:
+                row = skytools.db_urldecode(ev.data)
             if self.encoding_validator:
                 return self.encoding_validator.validate_dict(row, self.table_name)
             return row
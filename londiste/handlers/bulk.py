@@ -20,11 +20,40 @@ Methods:
 
 Default is 0.
 
+Rows are kept in memory until end of batch.  For huge batches use
+max_rows=N to flush them to database when N events are buffered:
+
+  londiste add-table xx --handler="bulk(max_rows=100000)"
+
+With binary=1, rows are loaded with binary COPY, if all column types
+are supported by londiste.bincopy.  Otherwise or if some value cannot
+be encoded, text COPY is used.
+
+With merge=1 on PostgreSQL 15+, deleted and updated rows are loaded into
+one temp table together with their operation and applied with single
+MERGE statement.  On older servers the method is used.  MERGE keeps
+semantics of method: with method 0 update of missing row is skipped,
+with methods 1 and 2 it inserts the row.  Inserts are COPY-ed into
+table afterwards, so insert of existing row fails as without merge;
+method 2 merges them with updates.  Skipped rows are reported as
+mismatch, per operation on PostgreSQL 17+, by total count on older
+servers.
+
+Only net state of each row is kept in memory.  With spill_size=SIZE,
+rows are moved to local temp files when their total size exceeds SIZE,
+and merged back one partition at a time at flush:
+
+  londiste add-table xx --handler="bulk(spill_size=256M)"
+
 """
 
+import pickle
+import tempfile
+
 import skytools
 from skytools import quote_fqident, quote_ident
 
+from londiste.bincopy import BinaryCopyEncoder, BufferReader
 from londiste.handler import BaseHandler
 
 __all__ = ['BulkLoader']
@@ -41,15 +70,81 @@ USE_LONGLIVED_TEMP_TABLES = True
 
 USE_REAL_TABLE = False
 
+# op column in temp table for MERGE
+MERGE_OP_COLUMN = '_londiste_op'
+MERGE_MIN_VERSION = 150000
+# MERGE .. RETURNING merge_action(), for counts per op
+MERGE_RETURNING_VERSION = 170000
+MERGE_ACTIONS = {'D': 'DELETE', 'U': 'UPDATE'}
+
+# read size for binary COPY data
+BINARY_COPY_READ_SIZE = 256 * 1024
 
-class BulkEvent:
-    """Helper class for BulkLoader to store relevant data."""
-    __slots__ = ('op', 'data', 'pk_data')
 
-    def __init__(self, op, data, pk_data):
-        self.op = op
-        self.data = data
-        self.pk_data = pk_data
+# number of spill files, rows are split by pkey hash
+SPILL_PARTITIONS = 16
+
+# net row state: [exists_before, exists_after, data],
+# exists_after is -1 when only updates have been seen
+_BEFORE, _AFTER, _DATA = 0, 1, 2
+
+
+def merge_row_state(state_map, pk_data, newer):
+    """Add row state of later events to map."""
+    older = state_map.get(pk_data)
+    if older is None:
+        state_map[pk_data] = newer
+    else:
+        if newer[_AFTER] >= 0:
+            older[_AFTER] = newer[_AFTER]
+        older[_DATA] = newer[_DATA]
+
+
+class SpillFiles:
+    """Row states moved out of memory, partitioned by pkey hash.
+
+    Each spill appends one pickled chunk per partition, so reading
+    chunks in order gives later states last.
+    """
+
+    def __init__(self, nparts=SPILL_PARTITIONS):
+        self.files = [None] * nparts
+
+    def partition(self, state_map):
+        parts = [[] for _ in self.files]
+        for pk_data, state in state_map.items():
+            parts[hash(pk_data) % len(parts)].append((pk_data, state))
+        return parts
+
+    def write(self, state_map):
+        for i, items in enumerate(self.partition(state_map)):
+            if not items:
+                continue
+            if self.files[i] is None:
+                self.files[i] = tempfile.TemporaryFile(prefix='londiste-bulk-')
+            pickle.dump(items, self.files[i], pickle.HIGHEST_PROTOCOL)
+
+    def read(self, nr):
+        """Return merged row states of partition."""
+        res = {}
+        f = self.files[nr]
+        if f is None:
+            return res
+        f.seek(0)
+        while True:
+            try:
+                items = pickle.load(f)
+            except EOFError:
+                break
+            for pk_data, state in items:
+                merge_row_state(res, pk_data, state)
+        return res
+
+    def close(self):
+        for f in self.files:
+            if f is not None:
+                f.close()
+        self.files = [None] * len(self.files)
 
 
 class BulkLoader(BaseHandler):
@@ -59,6 +154,14 @@ class BulkLoader(BaseHandler):
 
     Parameters:
       method=TYPE - method to use for copying [0..2] (default: 0)
+      max_rows=N  - flush buffered rows when N events are collected,
+                    0 means only at end of batch (default: 0)
+      binary=BOOL - load rows with binary COPY when column types
+                    allow it (default: 0)
+      merge=BOOL  - on PostgreSQL 15+ apply rows with single MERGE,
+                    keeping semantics of method (default: 0)
+      spill_size=SIZE - move buffered rows to temp files when their size
+                    exceeds SIZE, 0 keeps all in memory (default: 0)
 
     Methods:
       0 (correct) - inserts as COPY into table,
@@ -76,23 +179,39 @@ class BulkLoader(BaseHandler):
         super().__init__(table_name, args, dest_table)
 
         self.pkey_list = None
-        self.dist_fields = None
         self.col_list = None
 
         self.pkey_ev_map = {}
         self.method = int(args.get('method', DEFAULT_METHOD))
         if self.method not in (0, 1, 2):
             raise Exception('unknown method: %s' % self.method)
+        self.max_rows = int(args.get('max_rows', 0))
+        self.ev_count = 0
+
+        self.spill_size = skytools.hsize_to_bytes(args.get('spill_size', '0'))
+        self.spill_files = None
+        self.map_bytes = 0
+
+        self.binary = int(args.get('binary', 0))
+        self.merge = int(args.get('merge', 0))
 
         self.log.debug('bulk_init(%r), method=%d', args, self.method)
 
     def reset(self):
         self.pkey_ev_map = {}
+        self.ev_count = 0
+        self.map_bytes = 0
+        if self.spill_files:
+            self.spill_files.close()
+            self.spill_files = None
         super().reset()
 
     def finish_batch(self, batch_info, dst_curs):
         self.bulk_flush(dst_curs)
 
+    def flush_pending(self, dst_curs):
+        self.bulk_flush(dst_curs)
+
     def process_event(self, ev, sql_queue_func, arg):
         if len(ev.ev_type) < 2 or ev.ev_type[1] != ':':
             raise Exception('Unsupported event type: %s/extra1=%s/data=%s' % (
@@ -101,7 +220,9 @@ class BulkLoader(BaseHandler):
         if op not in 'IUD':
             raise Exception('Unknown event type: ' + ev.ev_type)
         # pkey_list = ev.ev_type[2:].split(',')
-        data = skytools.db_urldecode(ev.ev_data)
+        data = self.pop_parsed_row(ev)
+        if data is None:
+            data = skytools.db_urldecode(ev.ev_data)
 
         # get pkey value
         if self.pkey_list is None:
@@ -123,120 +244,110 @@ class BulkLoader(BaseHandler):
             # ^ supposedly python guarantees same order in keys()
             self.col_list = data.keys()
 
-        # keep all versions of row data
-        ev = BulkEvent(op, data, pk_data)
-        if ev.pk_data in self.pkey_ev_map:
-            self.pkey_ev_map[ev.pk_data].append(ev)
+        # keep net state of row
+        state = self.pkey_ev_map.get(pk_data)
+        if state is None:
+            after = 1 if op == 'I' else 0 if op == 'D' else -1
+            self.pkey_ev_map[pk_data] = [int(op != 'I'), after, data]
+            self.map_bytes += len(ev.ev_data)
         else:
-            self.pkey_ev_map[ev.pk_data] = [ev]
+            if op != 'U':
+                state[_AFTER] = int(op == 'I')
+            state[_DATA] = data
+        self.ev_count += 1
+
+        if self.spill_size and self.map_bytes >= self.spill_size:
+            self.spill()
+
+        # keep memory bounded, arg is destination cursor
+        if self.max_rows and self.ev_count >= self.max_rows:
+            self.log.debug('bulk: max_rows reached, flushing %s', self.table_name)
+            self.bulk_flush(arg)
+
+    def spill(self):
+        """Move row states from memory to temp files."""
+        if self.spill_files is None:
+            self.spill_files = SpillFiles()
+        self.log.debug('bulk: %s: spilling %d rows to temp files', self.table_name, len(self.pkey_ev_map))
+        self.spill_files.write(self.pkey_ev_map)
+        self.pkey_ev_map = {}
+        self.map_bytes = 0
 
-    def prepare_data(self):
+    def prepare_data(self, state_map):
         """Got all data, prepare for insertion."""
 
         del_list = []
         ins_list = []
         upd_list = []
-        for ev_list in self.pkey_ev_map.values():
-            # rewrite list of I/U/D events to
+        for exists_before, exists_after, data in state_map.values():
+            # rewrite net state to
             # optional DELETE and optional INSERT/COPY command
-            exists_before = -1
-            exists_after = 1
-            for ev in ev_list:
-                if ev.op == "I":
-                    if exists_before < 0:
-                        exists_before = 0
-                    exists_after = 1
-                elif ev.op == "U":
-                    if exists_before < 0:
-                        exists_before = 1
-                    #exists_after = 1 # this shouldnt be needed
-                elif ev.op == "D":
-                    if exists_before < 0:
-                        exists_before = 1
-                    exists_after = 0
-                else:
-                    raise Exception('unknown event type: %s' % ev.op)
+            if exists_after < 0:
+                exists_after = 1
 
             # skip short-lived rows
             if exists_before == 0 and exists_after == 0:
                 continue
 
-            # take last event
-            ev = ev_list[-1]
-
             # generate needed commands
             if exists_before and exists_after:
-                upd_list.append(ev.data)
+                upd_list.append(data)
             elif exists_before:
-                del_list.append(ev.data)
+                del_list.append(data)
             elif exists_after:
-                ins_list.append(ev.data)
+                ins_list.append(data)
 
         return ins_list, upd_list, del_list
 
     def bulk_flush(self, curs):
-        ins_list, upd_list, del_list = self.prepare_data()
+        if self.spill_files is None:
+            self.flush_rows(curs, *self.prepare_data(self.pkey_ev_map))
+        else:
+            # partition at a time, latest states are in memory
+            mem_parts = self.spill_files.partition(self.pkey_ev_map)
+            self.pkey_ev_map = {}
+            for nr, items in enumerate(mem_parts):
+                state_map = self.spill_files.read(nr)
+                for pk_data, state in items:
+                    merge_row_state(state_map, pk_data, state)
+                self.flush_rows(curs, *self.prepare_data(state_map))
+        self.reset()
 
-        # reorder cols, put pks first
-        col_list = self.pkey_list[:]
-        for k in self.col_list:
-            if k not in self.pkey_list:
-                col_list.append(k)
+    def flush_rows(self, curs, ins_list, upd_list, del_list):
+        if not (ins_list or upd_list or del_list):
+            return
+
+        # column order and key fields are cached per column signature
+        key = ('bulk_columns', self.dest_table, tuple(self.pkey_list), tuple(self.col_list))
+        col_list, key_fields = self.catalog_cache.get(curs, key, self.get_flush_columns)
 
         real_update_count = len(upd_list)
 
         self.log.debug("bulk_flush: %s  (I/U/D = %d/%d/%d)",
                        self.table_name, len(ins_list), len(upd_list), len(del_list))
 
+        if self.merge and key_fields and curs.connection.server_version >= MERGE_MIN_VERSION:
+            self.merge_flush(curs, ins_list, upd_list, del_list, col_list, key_fields)
+            return
+
         # hack to unbroke stuff
         if self.method == METH_MERGED:
             upd_list += ins_list
             ins_list = []
 
-        # fetch distribution fields
-        if self.dist_fields is None:
-            self.dist_fields = self.find_dist_fields(curs)
-
-        key_fields = self.pkey_list[:]
-        for fld in self.dist_fields:
-            if fld not in key_fields:
-                key_fields.append(fld)
-        self.log.debug("PKey fields: %s  Dist fields: %s",
-                       ",".join(self.pkey_list), ",".join(self.dist_fields))
-
         # create temp table
         temp, qtemp = self.create_temp_table(curs)
         tbl = self.dest_table
         qtbl = self.fq_dest_table
 
-        # where expr must have pkey and dist fields
-        klist = []
-        for pk in key_fields:
-            exp = "%s.%s = %s.%s" % (qtbl, quote_ident(pk),
-                                     qtemp, quote_ident(pk))
-            klist.append(exp)
-        whe_expr = " and ".join(klist)
-
-        # create del sql
-        del_sql = "delete from %s using %s where %s" % (qtbl, qtemp, whe_expr)
-
-        # create update sql
-        slist = []
-        for col in col_list:
-            if col not in key_fields:
-                exp = "%s = %s.%s" % (quote_ident(col), qtemp, quote_ident(col))
-                slist.append(exp)
-        upd_sql = "update %s set %s from %s where %s" % (qtbl, ", ".join(slist), qtemp, whe_expr)
+        key = ('bulk_sql', qtemp, tuple(col_list), tuple(key_fields))
+        del_sql, upd_sql, ins_sql = self.catalog_cache.get(
+            curs, key, lambda c: self.make_flush_sql(col_list, key_fields, qtemp))
 
         # avoid updates on pk-only table
-        if not slist:
+        if not upd_sql:
             upd_list = []
 
-        # insert sql
-        colstr = ",".join([quote_ident(c) for c in col_list])
-        ins_sql = "insert into %s (%s) select %s from %s" % (
-                  qtbl, colstr, colstr, qtemp)
-
         temp_used = False
 
         # process deleted rows
@@ -248,7 +359,7 @@ class BulkLoader(BaseHandler):
             curs.execute(q)
             # copy rows
             self.log.debug("bulk: COPY %d rows into %s", len(del_list), temp)
-            skytools.magic_insert(curs, qtemp, del_list, col_list, quoted_table=1)
+            self.copy_rows(curs, qtemp, del_list, col_list)
             # delete rows
             self.log.debug('bulk: %s', del_sql)
             curs.execute(del_sql)
@@ -267,7 +378,7 @@ class BulkLoader(BaseHandler):
             curs.execute(q)
             # copy rows
             self.log.debug("bulk: COPY %d rows into %s", len(upd_list), temp)
-            skytools.magic_insert(curs, qtemp, upd_list, col_list, quoted_table=1)
+            self.copy_rows(curs, qtemp, upd_list, col_list)
             temp_used = True
             if self.method == METH_CORRECT:
                 # update main table
@@ -291,7 +402,7 @@ class BulkLoader(BaseHandler):
                 if AVOID_BIZGRES_BUG:
                     # copy again, into main table
                     self.log.debug("bulk: COPY %d rows into %s", len(upd_list), tbl)
-                    skytools.magic_insert(curs, qtbl, upd_list, col_list, quoted_table=1)
+                    self.copy_rows(curs, qtbl, upd_list, col_list)
                 else:
                     # better way, but does not work due bizgres bug
                     self.log.debug('bulk: %s', ins_sql)
@@ -302,7 +413,7 @@ class BulkLoader(BaseHandler):
         if len(ins_list) > 0:
             self.log.debug("bulk: Inserting %d rows into %s", len(ins_list), tbl)
             self.log.debug("bulk: COPY %d rows into %s", len(ins_list), tbl)
-            skytools.magic_insert(curs, qtbl, ins_list, col_list, quoted_table=1)
+            self.copy_rows(curs, qtbl, ins_list, col_list)
 
         # delete remaining rows
         if temp_used:
@@ -314,30 +425,225 @@ class BulkLoader(BaseHandler):
             self.log.debug('bulk: %s', q)
             curs.execute(q)
 
-        self.reset()
+    def get_flush_columns(self, curs):
+        """Return columns with pks first, and key fields for joins."""
+        col_list = self.pkey_list[:]
+        for k in self.col_list:
+            if k not in self.pkey_list:
+                col_list.append(k)
 
-    def create_temp_table(self, curs):
+        # where expr must have pkey and dist fields
+        dist_fields = self.find_dist_fields(curs)
+        key_fields = self.pkey_list[:]
+        for fld in dist_fields:
+            if fld not in key_fields:
+                key_fields.append(fld)
+        self.log.debug("PKey fields: %s  Dist fields: %s",
+                       ",".join(self.pkey_list), ",".join(dist_fields))
+        return col_list, key_fields
+
+    def make_flush_sql(self, col_list, key_fields, qtemp):
+        """Return delete, update and insert statements using temp table.
+
+        Update is None for pk-only table.
+        """
+        qtbl = self.fq_dest_table
+        klist = []
+        for pk in key_fields:
+            exp = "%s.%s = %s.%s" % (qtbl, quote_ident(pk),
+                                     qtemp, quote_ident(pk))
+            klist.append(exp)
+        whe_expr = " and ".join(klist)
+
+        # create del sql
+        del_sql = "delete from %s using %s where %s" % (qtbl, qtemp, whe_expr)
+
+        # create update sql
+        slist = []
+        for col in col_list:
+            if col not in key_fields:
+                exp = "%s = %s.%s" % (quote_ident(col), qtemp, quote_ident(col))
+                slist.append(exp)
+        upd_sql = None
+        if slist:
+            upd_sql = "update %s set %s from %s where %s" % (qtbl, ", ".join(slist), qtemp, whe_expr)
+
+        # insert sql
+        colstr = ",".join([quote_ident(c) for c in col_list])
+        ins_sql = "insert into %s (%s) select %s from %s" % (
+                  qtbl, colstr, colstr, qtemp)
+        return del_sql, upd_sql, ins_sql
+
+    def make_merge_sql(self, col_list, key_fields, qtemp, returning):
+        """Return MERGE from temp table with op column.
+
+        With returning, statement gives row count per op and action.
+
+        >>> BulkLoader('public.t', {'method': '0'}, None).make_merge_sql(['id', 'v'], ['id'], 'tmp', False)
+        "merge into public.t as d using tmp as t on (d.id = t.id) when matched and t._londiste_op = 'D' then delete \
+when matched and t._londiste_op = 'U' then update set v = t.v"
+        >>> BulkLoader('public.t', {'method': '2'}, None).make_merge_sql(['id'], ['id'], 'tmp', True)
+        "with m as (merge into public.t as d using tmp as t on (d.id = t.id) \
+when matched and t._londiste_op = 'D' then delete \
+when not matched and t._londiste_op = 'U' then insert (id) values (t.id) \
+returning t._londiste_op as op, merge_action() as action) select op, action, count(*) from m group by 1, 2"
+        """
+        qop = "t." + quote_ident(MERGE_OP_COLUMN)
+        whe_expr = " and ".join(["d.%s = t.%s" % (quote_ident(k), quote_ident(k)) for k in key_fields])
+        slist = ["%s = t.%s" % (quote_ident(c), quote_ident(c)) for c in col_list if c not in key_fields]
+        colstr = ",".join([quote_ident(c) for c in col_list])
+        valstr = ",".join(["t." + quote_ident(c) for c in col_list])
+        q = "merge into %s as d using %s as t on (%s)" % (self.fq_dest_table, qtemp, whe_expr)
+        q += " when matched and %s = 'D' then delete" % qop
+        if slist:
+            q += " when matched and %s = 'U' then update set %s" % (qop, ", ".join(slist))
+        if self.method != METH_CORRECT:
+            # update is done as delete + insert
+            q += " when not matched and %s = 'U' then insert (%s) values (%s)" % (qop, colstr, valstr)
+        if returning:
+            q = "with m as (%s returning %s as op, merge_action() as action)"\
+                " select op, action, count(*) from m group by 1, 2" % (q, qop)
+        return q
+
+    def merge_flush(self, curs, ins_list, upd_list, del_list, col_list, key_fields):
+        """Load rows tagged with op into temp table, apply with single MERGE.
+
+        Inserts are COPY-ed into table after that.
+        """
+        # original update count, merged inserts may be updated or inserted
+        upd_count = len(upd_list)
+        # merged method loads inserts together with updates
+        if self.method == METH_MERGED:
+            upd_list = upd_list + ins_list
+            ins_list = []
+        rows = []
+        for op, op_list in (('D', del_list), ('U', upd_list)):
+            for data in op_list:
+                row = dict(data)
+                row[MERGE_OP_COLUMN] = op
+                rows.append(row)
+        if rows:
+            self.merge_rows(curs, rows, len(del_list), upd_count, col_list, key_fields)
+
+        # insert of existing row fails, as with method
+        if ins_list:
+            self.log.debug("bulk: COPY %d rows into %s", len(ins_list), self.dest_table)
+            self.copy_rows(curs, self.fq_dest_table, ins_list, col_list)
+
+    def merge_rows(self, curs, rows, del_count, upd_count, col_list, key_fields):
+        """Apply deleted and updated rows with MERGE."""
+        temp, qtemp = self.create_temp_table(curs, with_op=True)
+
+        self.log.debug("bulk: COPY %d rows into %s", len(rows), temp)
+        self.copy_rows(curs, qtemp, rows, col_list + [MERGE_OP_COLUMN])
+
+        returning = curs.connection.server_version >= MERGE_RETURNING_VERSION
+        key = ('bulk_merge_sql', qtemp, tuple(col_list), tuple(key_fields), self.method, returning)
+        q = self.catalog_cache.get(curs, key, lambda c: self.make_merge_sql(col_list, key_fields, qtemp, returning))
+        self.log.debug('bulk: %s', q)
+        curs.execute(q)
+        has_nonkeys = len(col_list) > len(key_fields)
+        if returning:
+            counts = {(row[0], row[1]): row[2] for row in curs.fetchall()}
+            self.log.debug("bulk: MERGE %s", counts)
+            for op, cnt, name in (('D', del_count, 'Delete'), ('U', upd_count, 'Update')):
+                # update on pk-only table does nothing
+                if op == 'U' and not has_nonkeys:
+                    continue
+                done = counts.get((op, MERGE_ACTIONS[op]), 0)
+                if cnt != done:
+                    self.log.warning("%s mismatch: expected=%s merged=%d", name, cnt, done)
+        else:
+            self.log.debug("bulk: %s - %d", curs.statusmessage, curs.rowcount)
+            if has_nonkeys and len(rows) != curs.rowcount:
+                self.log.warning("Merge mismatch: expected=%s (U/D = %d/%d) merged=%d", len(rows),
+                                 len(rows) - del_count, del_count, curs.rowcount)
+
+        q = "truncate %s" % qtemp
+        self.log.debug('bulk: %s', q)
+        curs.execute(q)
+
+    def copy_rows(self, curs, qtbl, rows, col_list):
+        """COPY rows into table, binary if enabled and possible."""
+        if self.binary:
+            enc = self.get_binary_encoder(curs, col_list)
+            if enc:
+                try:
+                    data = enc.encode(rows, col_list)
+                except ValueError as ex:
+                    self.log.debug("bulk: %s: using text COPY: %s", self.table_name, ex)
+                else:
+                    cols = ",".join([quote_ident(c) for c in col_list])
+                    q = "copy %s (%s) from stdin with (format binary)" % (qtbl, cols)
+                    curs.copy_expert(q, BufferReader(data), BINARY_COPY_READ_SIZE)
+                    return
+        skytools.magic_insert(curs, qtbl, rows, col_list, quoted_table=1)
+
+    def get_binary_encoder(self, curs, col_list):
+        """Return encoder for columns, None if binary COPY is not possible."""
+        key = ('bulk_binary_encoder', self.dest_table, tuple(col_list))
+        return self.catalog_cache.get(curs, key, lambda c: self.make_binary_encoder(c, col_list))
+
+    def make_binary_encoder(self, curs, col_list):
+        # fetch types again if columns have been added
+        key = ('column_types', self.dest_table)
+        col_types = self.catalog_cache.get(curs, key, self.find_column_types)
+        if not all(c in col_types for c in col_list if c != MERGE_OP_COLUMN):
+            col_types = self.find_column_types(curs)
+            self.catalog_cache.set(curs, key, col_types)
+        type_names = ['text' if c == MERGE_OP_COLUMN else col_types.get(c) for c in col_list]
+
+        if curs.connection.encoding not in ('UTF8', 'UNICODE'):
+            self.log.info("bulk: %s: client encoding not UTF8, using text COPY", self.table_name)
+            return None
+        if not BinaryCopyEncoder.supports(type_names):
+            self.log.info("bulk: %s: unsupported column types, using text COPY", self.table_name)
+            return None
+        return BinaryCopyEncoder(type_names)
+
+    def find_column_types(self, curs):
+        schema, name = skytools.fq_name_parts(self.dest_table)
+        q = "select a.attname, t.typname"\
+            "  from pg_class c, pg_namespace n, pg_attribute a, pg_type t"\
+            " where n.oid = c.relnamespace"\
+            "   and a.attrelid = c.oid"\
+            "   and t.oid = a.atttypid"\
+            "   and a.attnum > 0 and not a.attisdropped"\
+            "   and n.nspname = %s and c.relname = %s"
+        curs.execute(q, [schema, name])
+        res = {}
+        for row in curs.fetchall():
+            res[row[0]] = row[1]
+        return res
+
+    def create_temp_table(self, curs, with_op=False):
         if USE_REAL_TABLE:
             tempname = self.dest_table + "_loadertmpx"
         else:
             # create temp table for loading
             tempname = self.dest_table.replace('.', '_') + "_loadertmp"
 
-        # check if exists
+        # MERGE source has extra column for op
+        like = quote_fqident(self.dest_table)
+        if with_op:
+            tempname += "_op"
+            like += ", %s text" % quote_ident(MERGE_OP_COLUMN)
+
+        # check if exists, known existence is cached
+        key = ('table_exists', tempname)
         if USE_REAL_TABLE:
-            if skytools.exists_table(curs, tempname):
+            if self.catalog_cache.get(curs, key, lambda c: skytools.exists_table(c, tempname)):
                 self.log.debug("bulk: Using existing real table %s", tempname)
                 return tempname, quote_fqident(tempname)
 
             # create non-temp table
-            q = "create table %s (like %s)" % (
-                quote_fqident(tempname),
-                quote_fqident(self.dest_table))
+            q = "create table %s (like %s)" % (quote_fqident(tempname), like)
             self.log.debug("bulk: Creating real table: %s", q)
             curs.execute(q)
+            self.catalog_cache.set(curs, key, True)
             return tempname, quote_fqident(tempname)
         elif USE_LONGLIVED_TEMP_TABLES:
-            if skytools.exists_temp_table(curs, tempname):
+            if self.catalog_cache.get(curs, key, lambda c: skytools.exists_temp_table(c, tempname)):
                 self.log.debug("bulk: Using existing temp table %s", tempname)
                 return tempname, quote_ident(tempname)
 
@@ -345,10 +651,11 @@ class BulkLoader(BaseHandler):
         # removed arg = "on commit delete rows"
         arg = "on commit preserve rows"
         # create temp table for loading
-        q = "create temp table %s (like %s) %s" % (
-            quote_ident(tempname), quote_fqident(self.dest_table), arg)
+        q = "create temp table %s (like %s) %s" % (quote_ident(tempname), like, arg)
         self.log.debug("bulk: Creating temp table: %s", q)
         curs.execute(q)
+        if USE_LONGLIVED_TEMP_TABLES:
+            self.catalog_cache.set(curs, key, True)
         return tempname, quote_ident(tempname)
 
     def find_dist_fields(self, curs):
@@ -98,7 +98,9 @@ Mapping is determined by rows in table conf.sync_mapping
             self.log.debug('Batch SQL for %s saved.', self.dest_table)
 
     def parse_row_data(self, ev):
-        data = skytools.db_urldecode(ev.data)
+        data = self.pop_parsed_row(ev)
+        if data is None:
+            data = skytools.db_urldecode(ev.data)
         data = self.filter_columns(data)
         return data
 
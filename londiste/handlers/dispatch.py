@@ -114,6 +114,18 @@ method:
     * 2 (merged)  - as 'delete', but merge insert rows with update rows
     * 3 (insert)  - COPY inserts into table, error when other events
 
+merge:
+    apply bulk loads with MERGE on PostgreSQL 15+, older servers use method
+    * 0 - use method (default)
+    * 1 - COPY all rows with their operation into temp table and apply
+          them with single MERGE statement. Not used for method insert.
+          Semantics of method are kept: with method 0 update of missing
+          row is skipped, with methods 1 and 2 it inserts the row.
+          Inserts are COPY-ed into table afterwards, so insert of existing
+          row fails as without merge; method 2 merges them with updates.
+          Mismatch is reported per operation on PostgreSQL 17+, by total
+          count on older servers.
+
 fields:
     field name map for using just part of the fields and rename them
     * '*' - all fields. default
@@ -142,6 +154,19 @@ ignore_old_events:
     * 0 - handle all events in the same way (default)
     * 1 - ignore events coming for obsolete partitions
 
+part_cache_ttl:
+    how long (in seconds) to trust that partition exists without checking
+    it from database again, default 300. dropped and rolled back partitions
+    are forgotten immediately
+
+max_loaders:
+    how many per-table loaders to keep between batches, least recently
+    used ones are dropped first. default 100
+
+max_rows:
+    flush collected rows of all loaders when N rows are collected,
+    0 means only at end of batch. default 0
+
 ignore_truncate:
     * 0 - process truncate event (default)
     * 1 - ignore truncate event
@@ -164,6 +189,8 @@ creating or coping initial data to destination table.  --expect-sync and
 import datetime
 import re
 import logging
+import time
+from collections import OrderedDict
 from functools import partial
 from typing import Sequence, List, Tuple, Optional
 
@@ -172,6 +199,7 @@ from skytools import UsageError, quote_fqident, quote_ident
 from skytools.dbstruct import T_ALL, TableStruct
 from skytools.basetypes import Cursor
 
+from londiste.handler import BaseHandler
 from londiste.handlers import handler_args, update
 from londiste.handlers.shard import ShardHandler
 import londiste.util
@@ -205,6 +233,13 @@ PART_FUNC_ARGS = ['parent', 'part', 'pkeys', 'part_field', 'part_time', 'period'
 
 RETENTION_FUNC = "londiste.drop_obsolete_partitions"
 
+# op column in temp table for MERGE
+MERGE_OP_COLUMN = '_londiste_op'
+MERGE_MIN_VERSION = 150000
+# MERGE .. RETURNING merge_action(), for counts per op
+MERGE_RETURNING_VERSION = 170000
+MERGE_ACTIONS = {'D': 'DELETE', 'U': 'UPDATE'}
+
 
 #------------------------------------------------------------------------------
 # LOADERS
@@ -224,6 +259,10 @@ class BaseLoader:
     def flush(self, curs):
         raise NotImplementedError()
 
+    def reset(self):
+        """Forget collected rows."""
+        pass
+
 
 class DirectLoader(BaseLoader):
     def __init__(self, table, pkeys, log, conf):
@@ -241,6 +280,9 @@ class DirectLoader(BaseLoader):
             curs.execute("\n".join(mk_sql[op](row, self.table, self.pkeys)
                                    for op, row in self.data))
 
+    def reset(self):
+        self.data = []
+
 
 class BaseBulkCollectingLoader(BaseLoader):
     """ Collect events into I,U,D lists by pk and keep only last event
@@ -296,6 +338,9 @@ class BaseBulkCollectingLoader(BaseLoader):
         op_map = self.collect_data()
         self.bulk_flush(curs, op_map)
 
+    def reset(self):
+        self.pkey_ev_map = {}
+
     def bulk_flush(self, curs, op_map):
         pass
 
@@ -321,6 +366,8 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
         # key fields used in where part, possible to add non pk fields
         # (like dist keys in gp)
         self.keys = list(self.pkeys)
+        # temp table existence, dist fields and statements
+        self.catalog_cache = BaseHandler.catalog_cache
 
     def nonkeys(self):
         """returns fields not in keys"""
@@ -343,33 +390,101 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
     def _cols(self):
         return ','.join(quote_ident(f) for f in self.fields)
 
+    def cached_sql(self, curs, kind, func):
+        """Statement text per column signature, built by func().
+
+        >>> from types import SimpleNamespace
+        >>> curs = SimpleNamespace(connection=object())
+        >>> ld = BaseBulkTempLoader('public.t', ['id'], None, None)
+        >>> ld.fields = ['id', 'v']
+        >>> ld.cached_sql(curs, 'delete', ld._delete_sql)
+        'delete from public.t using public_t_loadertmp as t where public.t.id = t.id'
+        >>> ld.cached_sql(curs, 'delete', lambda: 'not called')
+        'delete from public.t using public_t_loadertmp as t where public.t.id = t.id'
+        >>> ld.fields = ['id', 'v', 'w']
+        >>> ld.cached_sql(curs, 'delete', lambda: 'new column list')
+        'new column list'
+        >>> ld.cached_sql(SimpleNamespace(connection=object()), 'delete', lambda: 'new connection')
+        'new connection'
+        >>> ld.catalog_cache.clear()
+        """
+        key = ('dispatch_sql', kind, self.table, tuple(self.fields), tuple(self.keys))
+        return self.catalog_cache.get(curs, key, lambda c: func())
+
     def insert(self, curs):
-        sql = "insert into %s (%s) select %s from %s" % (self.qtable, self._cols(), self._cols(), self.qtemp)
+        sql = self.cached_sql(curs, 'insert', self._insert_sql)
         self.logexec(curs, sql)
 
-    def update(self, curs):
-        qcols = [quote_ident(c) for c in self.nonkeys()]
+    def _insert_sql(self):
+        return "insert into %s (%s) select %s from %s" % (self.qtable, self._cols(), self._cols(), self.qtemp)
 
+    def update(self, curs):
+        sql = self.cached_sql(curs, 'update', self._update_sql)
         # no point to update pk-only table
+        if sql:
+            self.logexec(curs, sql)
+
+    def _update_sql(self):
+        qcols = [quote_ident(c) for c in self.nonkeys()]
         if not qcols:
-            return
+            return None
 
         tmpl = "%s = t.%s"
         eqlist = [tmpl % (c, c) for c in qcols]
         _set = ", ".join(eqlist)
 
-        sql = "update %s set %s from %s as t where %s" % (self.qtable, _set, self.qtemp, self._where())
-        self.logexec(curs, sql)
+        return "update %s set %s from %s as t where %s" % (self.qtable, _set, self.qtemp, self._where())
 
     def delete(self, curs):
-        sql = "delete from %s using %s as t where %s" % (self.qtable, self.qtemp, self._where())
+        sql = self.cached_sql(curs, 'delete', self._delete_sql)
+        self.logexec(curs, sql)
+
+    def _delete_sql(self):
+        return "delete from %s using %s as t where %s" % (self.qtable, self.qtemp, self._where())
+
+    def merge(self, curs, qtemp, method, returning):
+        """Apply rows from temp table with op column.
+
+        With returning, statement gives row count per op and action.
+        """
+        kind = ('merge', method, returning)
+        sql = self.cached_sql(curs, kind, partial(self._merge_sql, qtemp, method, returning))
         self.logexec(curs, sql)
 
+    def _merge_sql(self, qtemp, method, returning):
+        """
+        >>> ld = BaseBulkTempLoader('public.t', ['id'], None, None)
+        >>> ld.fields = ['id', 'v']
+        >>> ld._merge_sql('tmp', METH_CORRECT, False)
+        "merge into public.t as d using tmp as t on (d.id = t.id) when matched and t._londiste_op = 'D' then delete \
+when matched and t._londiste_op = 'U' then update set v = t.v"
+        >>> ld._merge_sql('tmp', METH_DELETE, False)
+        "merge into public.t as d using tmp as t on (d.id = t.id) when matched and t._londiste_op = 'D' then delete \
+when matched and t._londiste_op = 'U' then update set v = t.v \
+when not matched and t._londiste_op = 'U' then insert (id,v) values (t.id,t.v)"
+        """
+        qop = "t." + quote_ident(MERGE_OP_COLUMN)
+        on = " and ".join("d.%s = t.%s" % (quote_ident(f), quote_ident(f)) for f in self.keys)
+        _set = ", ".join("%s = t.%s" % (c, c) for c in (quote_ident(f) for f in self.nonkeys()))
+        values = ",".join("t." + quote_ident(f) for f in self.fields)
+        sql = "merge into %s as d using %s as t on (%s)" % (self.qtable, qtemp, on)
+        sql += " when matched and %s = 'D' then delete" % qop
+        if _set:
+            sql += " when matched and %s = 'U' then update set %s" % (qop, _set)
+        if method != METH_CORRECT:
+            # update is done as delete + insert
+            sql += " when not matched and %s = 'U' then insert (%s) values (%s)" % (qop, self._cols(), values)
+        if returning:
+            sql = "with m as (%s returning %s as op, merge_action() as action)" \
+                  " select op, action, count(*) from m group by 1, 2" % (sql, qop)
+        return sql
+
     def truncate(self, curs):
         self.logexec(curs, "truncate %s" % self.qtemp)
 
     def drop(self, curs):
         self.logexec(curs, "drop table %s" % self.qtemp)
+        self.catalog_cache.set(curs, ('table_exists', self.temp), False)
 
     def create(self, curs):
         if USE_REAL_TABLE:
@@ -377,6 +492,7 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
         else:
             tmpl = "create temp table %s (like %s) on commit preserve rows"
         self.logexec(curs, tmpl % (self.qtemp, self.qtable))
+        self.catalog_cache.set(curs, ('table_exists', self.temp), True)
 
     def analyze(self, curs):
         self.logexec(curs, "analyze %s" % self.qtemp)
@@ -397,6 +513,9 @@ class BulkLoader(BaseBulkTempLoader):
         self.dist_fields = None
         # is temp table created
         self.temp_present = False
+        # temp table with op column, for MERGE
+        self.merge_temp = self.temp + "_op"
+        self.qmerge_temp = quote_fqident(self.merge_temp) if USE_REAL_TABLE else quote_ident(self.merge_temp)
 
     def process(self, op, row):
         if self.method == METH_INSERT and op != 'I':
@@ -473,7 +592,7 @@ class BulkLoader(BaseBulkTempLoader):
 
         # fetch distribution fields
         if self.dist_fields is None:
-            self.dist_fields = self.find_dist_fields(curs)
+            self.dist_fields = self.catalog_cache.get(curs, ('dist_fields', self.table), self.find_dist_fields)
             self.log.debug("Key fields: %s  Dist fields: %s",
                            ",".join(self.pkeys), ",".join(self.dist_fields))
             # add them to key
@@ -481,6 +600,11 @@ class BulkLoader(BaseBulkTempLoader):
                 if key not in self.keys:
                     self.keys.append(key)
 
+        if self.conf['merge'] and self.method != METH_INSERT \
+                and curs.connection.server_version >= MERGE_MIN_VERSION:
+            self.merge_flush(curs, op_map)
+            return
+
         # check if temp table present
         self.check_temp(curs)
         # process I,U,D
@@ -490,11 +614,65 @@ class BulkLoader(BaseBulkTempLoader):
         # truncate or drop temp table
         self.clean_temp(curs)
 
-    def check_temp(self, curs):
+    def merge_flush(self, curs, op_map):
+        """Load deleted and updated rows with op into temp table, apply with
+        single MERGE.  Inserts are COPY-ed into table after that."""
+        fields = list(self.fields or [])
+        # merged method loads inserts together with updates
+        if self.method == METH_MERGED:
+            op_lists = (('D', op_map['D']), ('U', op_map['U'] + op_map['I']))
+        else:
+            op_lists = (('D', op_map['D']), ('U', op_map['U']))
+        rows = []
+        for op, op_list in op_lists:
+            for row in op_list:
+                rows.append([row[f] for f in fields] + [op])
+        if rows:
+            self.merge_rows(curs, rows, op_map)
+        # insert of existing row fails, as with method
+        self.process_insert(curs, op_map)
+
+    def merge_rows(self, curs, rows, op_map):
+        """Apply deleted and updated rows with MERGE."""
+        fields = list(self.fields or [])
+
         if USE_REAL_TABLE:
-            self.temp_present = skytools.exists_table(curs, self.temp)
+            exists_func = skytools.exists_table
+            tmpl = "create table %s (like %s, %s text)"
         else:
-            self.temp_present = skytools.exists_temp_table(curs, self.temp)
+            exists_func = skytools.exists_temp_table
+            tmpl = "create temp table %s (like %s, %s text) on commit preserve rows"
+        key = ('table_exists', self.merge_temp)
+        if not self.catalog_cache.get(curs, key, lambda c: exists_func(c, self.merge_temp)):
+            self.logexec(curs, tmpl % (self.qmerge_temp, self.qtable, quote_ident(MERGE_OP_COLUMN)))
+            self.catalog_cache.set(curs, key, True)
+
+        self.log.debug("bulk: COPY %d rows into %s", len(rows), self.merge_temp)
+        skytools.magic_insert(curs, self.qmerge_temp, rows, fields + [MERGE_OP_COLUMN], quoted_table=True)
+        if self.run_analyze:
+            self.logexec(curs, "analyze %s" % self.qmerge_temp)
+        returning = curs.connection.server_version >= MERGE_RETURNING_VERSION
+        self.merge(curs, self.qmerge_temp, self.method, returning)
+        # check count (only in direct mode)
+        if returning:
+            counts = {(row[0], row[1]): row[2] for row in curs.fetchall()}
+            for op, cnt, name in (('D', len(op_map['D']), 'Delete'), ('U', len(op_map['U']), 'Update')):
+                # update on pk-only table does nothing
+                if self.conf.table_mode != 'direct' or (op == 'U' and not self.nonkeys()):
+                    continue
+                done = counts.get((op, MERGE_ACTIONS[op]), 0)
+                if cnt != done:
+                    self.log.warning("%s: %s mismatch: expected=%s merged=%d",
+                                     self.table, name, cnt, done)
+        elif self.conf.table_mode == 'direct' and self.nonkeys() and len(rows) != curs.rowcount:
+            self.log.warning("%s: Merge mismatch: expected=%s merged=%d",
+                             self.table, len(rows), curs.rowcount)
+        self.logexec(curs, "truncate %s" % self.qmerge_temp)
+
+    def check_temp(self, curs):
+        exists_func = skytools.exists_table if USE_REAL_TABLE else skytools.exists_temp_table
+        key = ('table_exists', self.temp)
+        self.temp_present = self.catalog_cache.get(curs, key, lambda c: exists_func(c, self.temp))
 
     def clean_temp(self, curs):
         # delete remaining rows
@@ -565,9 +743,14 @@ LOADERS = {'direct': DirectLoader, 'bulk': BulkLoader}
 #------------------------------------------------------------------------------
 
 class RowHandler:
-    def __init__(self, log):
+    def __init__(self, log, max_loaders=100):
         self.log = log
-        self.table_map = {}
+        self.max_loaders = max_loaders
+        # least recently used first
+        self.table_map = OrderedDict()
+        # tables with rows since last flush
+        self.pending_tables = set()
+        self.row_count = 0
 
     def add_table(self, table, ldr_cls, pkeys, args):
         self.table_map[table] = ldr_cls(table, pkeys, self.log, args)
@@ -577,10 +760,27 @@ class RowHandler:
             self.table_map[table].process(op, row)
         except KeyError:
             raise Exception("No loader for table %s" % table) from None
+        self.table_map.move_to_end(table)
+        self.pending_tables.add(table)
+        self.row_count += 1
 
     def flush(self, curs):
-        for ldr in self.table_map.values():
-            ldr.flush(curs)
+        # idle loaders have nothing to do
+        for table, ldr in self.table_map.items():
+            if table in self.pending_tables:
+                ldr.flush(curs)
+        self.reset()
+        # loaders are empty now, drop ones not used lately
+        while len(self.table_map) > self.max_loaders:
+            table, _ = self.table_map.popitem(last=False)
+            self.log.debug("dropping idle loader: %s", table)
+
+    def reset(self):
+        for table in self.pending_tables:
+            if table in self.table_map:
+                self.table_map[table].reset()
+        self.pending_tables = set()
+        self.row_count = 0
 
 
 class KeepAllRowHandler(RowHandler):
@@ -629,6 +829,9 @@ class Dispatcher(ShardHandler):
     """
     handler_name = 'dispatch'
 
+    # loaders flush whole temp table cycle, only at end of batch
+    flush_on_retry = False
+
     @property
     def __doc__(self):
         return self._doc_
@@ -648,7 +851,7 @@ class Dispatcher(ShardHandler):
         self.pkeys = None
         # config
         hdlr_cls = ROW_HANDLERS[self.conf.row_mode]
-        self.row_handler = hdlr_cls(self.log)
+        self.row_handler = hdlr_cls(self.log, self.conf.max_loaders)
 
     def _parse_args_from_doc(self):
         doc = __doc__
@@ -692,8 +895,13 @@ class Dispatcher(ShardHandler):
             conf.part_func = self.args.get('part_func', PART_FUNC_NEW)
             conf.retention_period = self.args.get('retention_period')
             conf.ignore_old_events = self.get_arg('ignore_old_events', [0, 1], 0)
+            conf.part_cache_ttl = float(self.args.get('part_cache_ttl', 300))
         # set row mode and event types to process
         conf.row_mode = self.get_arg('row_mode', ROW_MODES)
+        conf.max_loaders = int(self.args.get('max_loaders', 100))
+        if conf.max_loaders < 0:
+            raise Exception('max_loaders must be >= 0')
+        conf.max_rows = int(self.args.get('max_rows', 0))
         event_types = self.args.get('event_types', '*')
         if event_types == '*':
             event_types = EVENT_TYPES
@@ -706,6 +914,7 @@ class Dispatcher(ShardHandler):
         # set load handler
         conf.load_mode = self.get_arg('load_mode', LOAD_MODES)
         conf.method = self.get_arg('method', METHODS)
+        conf.merge = self.get_arg('merge', [0, 1])
         # fields to skip
         conf.skip_fields = [f.strip().lower()
                             for f in self.args.get('skip_fields', '').split(',')]
@@ -726,12 +935,17 @@ class Dispatcher(ShardHandler):
     def _validate_hash_key(self):
         pass  # no need for hash key when not sharding
 
+    def reset(self):
+        """Drop rows left from failed batch."""
+        self.row_handler.reset()
+        super().reset()
+
     def prepare_batch(self, batch_info, src_curs, dst_curs):
         """Called on first event for this table in current batch."""
         if batch_info is not None and self.conf.table_mode != 'ignore':
             self.batch_info = batch_info
             self.dst_curs = dst_curs
-        super().prepare_batch(batch_info, dst_curs)
+        super().prepare_batch(batch_info, src_curs, dst_curs)
 
     def filter_data(self, data):
         """Process with fields skip and map"""
@@ -763,7 +977,9 @@ class Dispatcher(ShardHandler):
         if self.conf.table_mode == 'ignore':
             return
         # get data
-        data = skytools.db_urldecode(ev.data)
+        data = self.pop_parsed_row(ev)
+        if data is None:
+            data = skytools.db_urldecode(ev.data)
         if self.encoding_validator:
             data = self.encoding_validator.validate_dict(data, self.table_name)
         if len(ev.ev_type) < 2 or ev.ev_type[1] != ':':
@@ -796,11 +1012,19 @@ class Dispatcher(ShardHandler):
                                        self.pkeys, self.conf)
         self.row_handler.process(dst, op, data)
 
+        # keep memory bounded, arg is destination cursor
+        if self.conf.max_rows and self.row_handler.row_count >= self.conf.max_rows:
+            self.log.debug('dispatch: max_rows reached, flushing %s', self.table_name)
+            self.row_handler.flush(arg)
+
     def finish_batch(self, batch_info, dst_curs):
         """Called when batch finishes."""
         if self.conf.table_mode != 'ignore':
             self.row_handler.flush(dst_curs)
-        #super().finish_batch(batch_info, dst_curs)
+
+    def flush_pending(self, dst_curs):
+        if self.conf.table_mode != 'ignore':
+            self.row_handler.flush(dst_curs)
 
     def get_part_name(self):
         # if custom part name template given, use it
@@ -841,13 +1065,17 @@ class Dispatcher(ShardHandler):
         else if part function present in db, call it
         else clone master table"""
         curs = self.dst_curs
+        if self.part_known(curs, dst):
+            return
         if (self.conf.ignore_old_events and self.conf.retention_period and
                 self.is_obsolete_partition(dst, self.conf.retention_period, self.conf.period)):
             self.ignored_tables.add(dst)
             return
         if skytools.exists_table(curs, dst):
+            self.set_part_known(curs, dst, True)
             return
 
+        part = dst
         dst = quote_fqident(dst)
         vals = {'dest': dst,
                 'part': dst,
@@ -901,15 +1129,26 @@ class Dispatcher(ShardHandler):
 
         exec_with_vals(self.conf.post_part)
         self.log.info("Created table: %s", dst)
+        self.set_part_known(curs, part, True)
 
         if self.conf.retention_period:
             dropped = self.drop_obsolete_partitions(self.dest_table, self.conf.retention_period, self.conf.period)
+            for tbl in dropped:
+                self.set_part_known(curs, tbl, False)
             if self.conf.ignore_old_events and dropped:
                 for tbl in dropped:
                     self.ignored_tables.add(tbl)
                     if tbl in self.row_handler.table_map:
                         del self.row_handler.table_map[tbl]
 
+    def part_known(self, curs, part):
+        """Partition was seen in database less than part_cache_ttl seconds ago."""
+        seen = self.catalog_cache.get(curs, ('part_seen', part), lambda c: None)
+        return seen is not None and time.time() - seen < self.conf.part_cache_ttl
+
+    def set_part_known(self, curs, part, exists):
+        self.catalog_cache.set(curs, ('part_seen', part), time.time() if exists else None)
+
     def drop_obsolete_partitions(self, parent_table, retention_period, partition_period):
         """ Drop obsolete partitions of partition-by-date parent table.
         """
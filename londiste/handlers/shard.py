@@ -24,7 +24,7 @@ Custom parameters from config file
 
 """
 
-from typing import Dict
+from typing import Dict, Optional
 
 import skytools
 
@@ -44,17 +44,15 @@ class ShardHandler(TableHandler):
 
     DEFAULT_HASH_EXPR = "%s(%s)"
 
-    hash_key: str
+    hash_key: Optional[str]
     hash_expr: str
 
     def __init__(self, table_name: str, args: Dict[str, str], dest_table: str) -> None:
         super().__init__(table_name, args, dest_table)
 
         # primary key columns
-        hash_key = args.get('hash_key', args.get('key'))
-        if hash_key is None:
-            raise Exception('Specify hash key field as hash_key argument')
-        self.hash_key = hash_key
+        self.hash_key = args.get('hash_key', args.get('key'))
+        self._validate_hash_key()
 
         # hash function & full expression
         self.hash_expr = self.DEFAULT_HASH_EXPR % (
@@ -69,10 +67,15 @@ class ShardHandler(TableHandler):
         _SHARD_HASH_FUNC = cf.get("shard_hash_func", _SHARD_HASH_FUNC)
         _SHARD_INFO_SQL = cf.get("shard_info_sql", _SHARD_INFO_SQL)
 
+    def _validate_hash_key(self) -> None:
+        if self.hash_key is None:
+            raise Exception('Specify hash key field as hash_key argument')
+
     def add(self, trigger_arg_list):
         """Let trigger put hash into extra3"""
-        arg = "ev_extra3='hash='||%s" % self.hash_expr
-        trigger_arg_list.append(arg)
+        if self.hash_key is not None:
+            arg = "ev_extra3='hash='||%s" % self.hash_expr
+            trigger_arg_list.append(arg)
         super().add(trigger_arg_list)
 
     def is_local_shard_event(self, ev):
@@ -86,17 +89,23 @@ class ShardHandler(TableHandler):
 
     def prepare_batch(self, batch_info, src_curs, dst_curs):
         """Called on first event for this table in current batch."""
-        if _SHARD_MASK is None:
+        if self.hash_key is not None and _SHARD_MASK is None:
             self.load_shard_info(dst_curs)
-        super().prepare_batch(batch_info, dst_curs)
+        super().prepare_batch(batch_info, src_curs, dst_curs)
 
     def process_event(self, ev, sql_queue_func, arg):
         """Filter event by hash in extra3, apply only if for local shard."""
-        if self.is_local_shard_event(ev):
-            super().process_event(ev, sql_queue_func, arg)
+        if self.hash_key is None or self.is_local_shard_event(ev):
+            self._process_event(ev, sql_queue_func, arg)
+
+    def _process_event(self, ev, sql_queue_func, arg):
+        """Apply event for local shard."""
+        super().process_event(ev, sql_queue_func, arg)
 
     def get_copy_condition(self, src_curs, dst_curs):
         """Prepare the where condition for copy and replay filtering"""
+        if self.hash_key is None:
+            return ''
         self.load_shard_info(dst_curs)
         expr = "(%s & %d) = %d" % (self.hash_expr, _SHARD_MASK, _SHARD_NR)
         self.log.debug('shard: copy_condition=%r', expr)
@@ -120,10 +129,14 @@ class ShardHandler(TableHandler):
         _SHARD_MASK = shard_mask
 
     def get_copy_event(self, ev, queue_name):
-        if self.is_local_shard_event(ev):
+        if self.hash_key is None or self.is_local_shard_event(ev):
             return ev
         return None
 
+    def rewrites_copy_event(self) -> bool:
+        # without hash key all events are copied as-is
+        return self.hash_key is not None
+
 
 class PartHandler(ShardHandler):
     __doc__ = "Deprecated compat name for shard handler.\n" + __doc__.split('\n', 1)[1]
@@ -0,0 +1,211 @@
+"""Replay timing metrics.
+
+Phase timers feed histograms, which are cumulative over process
+lifetime and can be written to file in Prometheus text format:
+
+>>> m = BatchMetrics()
+>>> m.observe('flush_sql', 0.003)
+>>> m.observe('flush_sql', 0.2)
+>>> h = m.histograms['flush_sql']
+>>> h.count, h.counts[:6]
+(2, [0, 1, 0, 0, 0, 1])
+>>> lines = m.format_metrics({'job': 'l3'})
+>>> lines[1]
+'londiste_batch_phase_seconds_bucket{job="l3",phase="flush_sql",le="0.001"} 0'
+>>> lines[3]
+'londiste_batch_phase_seconds_bucket{job="l3",phase="flush_sql",le="0.01"} 1'
+>>> lines[-1]
+'londiste_batch_phase_seconds_count{job="l3",phase="flush_sql"} 2'
+
+Per-table counters are kept for current period and summed into
+totals on flush:
+
+>>> c = TableCounters()
+>>> c.applied('public.t', 'I', 20, 0.001)
+>>> c.applied('public.t', 'U', 30, 0.002)
+>>> c.ignored('public.t', 'D', 10)
+>>> c.flush()
+{'public.t': {'I': 1, 'U': 1, 'ignored_D': 1, 'bytes': 60, 'process_time': 0.003}}
+>>> c.flush()
+{}
+>>> c.format_metrics({'job': 'l3'})[1]
+'londiste_table_events_total{job="l3",table="public.t",op="I",status="applied"} 1'
+"""
+
+import os
+import time
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
+
+__all__ = ['Histogram', 'BatchMetrics', 'TableCounters']
+
+# histogram bucket upper bounds, in seconds
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+# per-table counter slots
+TABLE_FIELDS = ('I', 'U', 'D', 'ignored_I', 'ignored_U', 'ignored_D',
+                'bytes', 'process_time', 'finish_time')
+_OP_SLOT = {'I': 0, 'U': 1, 'D': 2}
+_BYTES, _PROCESS_TIME, _FINISH_TIME = 6, 7, 8
+
+
+def _fmt_labels(labels: Dict[str, str]) -> str:
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append('%s="%s"' % (k, v))
+    return '{%s}' % ','.join(parts)
+
+
+def _fmt_value(val: float) -> str:
+    return repr(round(val, 6))
+
+
+class Histogram:
+    """Counts of observed values per bucket."""
+
+    def __init__(self, buckets: Sequence[float] = PHASE_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def format_metrics(self, name: str, labels: Dict[str, str]) -> List[str]:
+        """Return lines in Prometheus text format, buckets are cumulative."""
+        res = []
+        total = 0
+        for bound, cnt in zip(self.buckets, self.counts):
+            total += cnt
+            res.append('%s_bucket%s %d' % (name, _fmt_labels(dict(labels, le=repr(bound))), total))
+        res.append('%s_bucket%s %d' % (name, _fmt_labels(dict(labels, le='+Inf')), self.count))
+        res.append('%s_sum%s %s' % (name, _fmt_labels(labels), _fmt_value(self.sum)))
+        res.append('%s_count%s %d' % (name, _fmt_labels(labels), self.count))
+        return res
+
+
+class BatchMetrics:
+    """Timing histograms for batch processing phases."""
+
+    metric_name = 'londiste_batch_phase_seconds'
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Histogram] = {}
+        # durations of phases in current batch
+        self.last: Dict[str, float] = {}
+
+    def observe(self, phase: str, seconds: float) -> None:
+        hist = self.histograms.get(phase)
+        if hist is None:
+            hist = self.histograms[phase] = Histogram()
+        hist.observe(seconds)
+        self.last[phase] = self.last.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        """Measure duration of with-block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def start_batch(self) -> None:
+        self.last = {}
+
+    def format_metrics(self, labels: Dict[str, str]) -> List[str]:
+        res = ['# TYPE %s histogram' % self.metric_name]
+        for phase, hist in sorted(self.histograms.items()):
+            res.extend(hist.format_metrics(self.metric_name, dict(labels, phase=phase)))
+        return res
+
+    def write_file(self, filename: str, labels: Dict[str, str], extra: Optional[List[str]] = None) -> None:
+        """Replace metrics file atomically."""
+        lines = self.format_metrics(labels)
+        if extra:
+            lines.extend(extra)
+        tmp = '%s.tmp' % filename
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, filename)
+
+
+class TableCounters:
+    """Event counts, payload bytes and handler time per table.
+
+    Each table has fixed list of slots, see TABLE_FIELDS.
+    """
+
+    def __init__(self) -> None:
+        self.current: Dict[str, List[float]] = {}
+        self.totals: Dict[str, List[float]] = {}
+
+    def _slots(self, table: str) -> List[float]:
+        slots = self.current.get(table)
+        if slots is None:
+            slots = self.current[table] = [0] * len(TABLE_FIELDS)
+        return slots
+
+    def applied(self, table: str, op: str, nbytes: int, seconds: float) -> None:
+        slots = self._slots(table)
+        if op in _OP_SLOT:
+            slots[_OP_SLOT[op]] += 1
+        slots[_BYTES] += nbytes
+        slots[_PROCESS_TIME] += seconds
+
+    def ignored(self, table: str, op: str, nbytes: int) -> None:
+        slots = self._slots(table)
+        if op in _OP_SLOT:
+            slots[_OP_SLOT[op] + 3] += 1
+        slots[_BYTES] += nbytes
+
+    def finished(self, table: str, seconds: float) -> None:
+        self._slots(table)[_FINISH_TIME] += seconds
+
+    def flush(self) -> Dict[str, Dict[str, float]]:
+        """Return non-zero counters of current period and start new one."""
+        res = {}
+        for table, slots in self.current.items():
+            total = self.totals.get(table)
+            if total is None:
+                total = self.totals[table] = [0] * len(TABLE_FIELDS)
+            vals = {}
+            for i, val in enumerate(slots):
+                total[i] += val
+                if val:
+                    vals[TABLE_FIELDS[i]] = round(val, 6) if i >= _PROCESS_TIME else val
+            res[table] = vals
+        self.current = {}
+        return res
+
+    def format_metrics(self, labels: Dict[str, str]) -> List[str]:
+        """Totals in Prometheus text format, current period included."""
+        sums = {}
+        for src in (self.totals, self.current):
+            for table, slots in src.items():
+                dst = sums.setdefault(table, [0] * len(TABLE_FIELDS))
+                for i, val in enumerate(slots):
+                    dst[i] += val
+
+        res = ['# TYPE londiste_table_events_total counter']
+        for table, slots in sorted(sums.items()):
+            for op, i in _OP_SLOT.items():
+                for status, val in (('applied', slots[i]), ('ignored', slots[i + 3])):
+                    lbl = dict(labels, table=table, op=op, status=status)
+                    res.append('londiste_table_events_total%s %d' % (_fmt_labels(lbl), val))
+        for name, i in (('londiste_table_event_bytes_total', _BYTES),
+                        ('londiste_table_process_seconds_total', _PROCESS_TIME),
+                        ('londiste_table_finish_seconds_total', _FINISH_TIME)):
+            res.append('# TYPE %s counter' % name)
+            for table, slots in sorted(sums.items()):
+                res.append('%s%s %s' % (name, _fmt_labels(dict(labels, table=table)), _fmt_value(slots[i])))
+        return res
@@ -2,19 +2,26 @@
 """
 
 import os
+import select
 import sys
 import time
 import fnmatch
 import yaml
 
-from typing import List, Optional, Dict, Sequence
+from typing import List, Optional, Dict, Sequence, Union
 
 import skytools
 
 from pgq.cascade.worker import CascadedWorker
+from pgq.event import Event
 
+from .event_filter import get_pushdown_filter, load_event_filters, parse_event_row
+from .copy_pool import CopyScheduler
 from .exec_attrs import ExecAttrs
-from .handler import build_handler, load_handler_modules
+from .fkey_validator import FkeyValidator, is_marked, unmark_pending
+from .handler import BaseHandler, RowBatch, PreparedStatementCache, build_handler, load_handler_modules
+from .metrics import BatchMetrics, TableCounters
+from .prefetch import PrefetchBatchWalker
 
 from londiste.deny_trigger_manager import DenyTriggerManager
 
@@ -37,6 +44,16 @@ SYNC_EXIT = 2  # nothing to do, exit script
 
 MAX_PARALLEL_COPY = 8  # default number of allowed max parallel copy processes
 
+# channel for table state change notifications on destination
+TABLE_STATE_CHANNEL = 'londiste_table_state'
+
+# order of starting copies for missing tables
+COPY_ORDERS = ('default', 'smallest', 'largest', 'fair')
+
+# bounds for autotuned apply_batch_count
+AUTOTUNE_MIN_COUNT = 10
+AUTOTUNE_MAX_COUNT = 10000
+
 
 def is_data_event(ev):
     """Is it insert/update/delete for one table?
@@ -101,6 +118,8 @@ class TableState:
         self.copy_role = None
         self.dropped_ddl = None
         self.plugin = None
+        # (handler string, dest_table) plugin was built from
+        self.plugin_key = None
         # except this
         self.changed = 0
         # position in parallel copy work order
@@ -120,6 +139,7 @@ class TableState:
         self.table_attrs = {}
         self.changed = 1
         self.plugin = None
+        self.plugin_key = None
         self.copy_pos = 0
         self.max_parallel_copy = MAX_PARALLEL_COPY
 
@@ -221,7 +241,15 @@ class TableState:
 
         hstr = self.table_attrs.get('handlers', '')  # compat
         hstr = self.table_attrs.get('handler', hstr)
-        self.plugin = build_handler(self.name, hstr, self.dest_table)
+        plugin_key = (hstr, self.dest_table)
+        if self.plugin is None or self.plugin_key != plugin_key:
+            self.plugin = build_handler(self.name, hstr, self.dest_table)
+            self.plugin_key = plugin_key
+
+    def drop_plugin(self):
+        """Forget handler instance, next loaded_state() builds new one."""
+        self.plugin = None
+        self.plugin_key = None
 
     def max_parallel_copies_reached(self):
         return self.max_parallel_copy and\
@@ -312,6 +340,25 @@ class Replicator(CascadedWorker):
         # how many tables can be copied in parallel
         #parallel_copies = 1
 
+        # run copies in pool of parallel_copies processes owned by worker,
+        # instead of launching separate copy daemon for each table
+        #copy_pool = false
+
+        # order for starting copies, by provider-side size estimate:
+        # default (table list order), smallest, largest, or fair - smallest first,
+        # and tables larger than copy_large_table_size may use at most
+        # parallel_copies - 1 copy slots, so small tables keep moving
+        #copy_order = default
+        #copy_large_table_size = 1G
+
+        # send NOTIFY on table state changes and wait for it with LISTEN,
+        # instead of only polling table state
+        #table_state_notify = true
+
+        # restore fkeys as NOT VALID and run VALIDATE CONSTRAINT in background,
+        # on this many parallel connections.  0 restores fully valid fkeys inline.
+        #fkey_validate_workers = 0
+
         # glob patterns for table names: archive.*, public.*
         #threaded_copy_tables =
         # number of threads in pool
@@ -320,6 +367,49 @@ class Replicator(CascadedWorker):
         # accept only events for locally present tables
         #local_only = true
 
+        # translate simple partialConditionSlave filters to SQL and let
+        # provider skip non-matching events (used only on nodes
+        # that do not forward events)
+        #event_filter_pushdown = false
+
+        # flush queued statements when any of the limits is reached:
+        # statement count, total size in bytes (0 - no limit),
+        # seconds since first queued statement (0 - no limit)
+        #apply_batch_count = 200
+        #apply_batch_bytes = 1048576
+        #apply_batch_delay = 0
+
+        # adjust apply_batch_count so that flush takes about target_latency seconds
+        #apply_batch_autotune = false
+        #apply_batch_target_latency = 0.1
+
+        # read batch events through server-side cursor in blocks of this size,
+        # so memory use does not depend on batch size.  0 loads whole batch at once.
+        # bulk handlers buffer rows until end of batch, see their max_rows argument
+        #pgq_lazy_fetch = 300
+
+        # read batch events in background thread, on separate provider connection,
+        # keeping up to batch_prefetch_chunks blocks of pgq_lazy_fetch events
+        #batch_prefetch = false
+        #batch_prefetch_chunks = 4
+
+        # on branch nodes, forwarded events are buffered and written to local
+        # queue with COPY when buffer has this many events, and at batch end
+        #copy_event_buffer = 5000
+
+        # max number of server-side prepared statements kept per connection,
+        # used by handlers with prepared=1 argument
+        #prepared_statement_cache_size = 100
+
+        # write batch phase timing histograms to file in Prometheus text format,
+        # at most once per metrics_interval seconds
+        #metrics_file =
+        #metrics_interval = 60
+
+        # log per-table event counts, payload bytes and handler time
+        # every table_stats_interval seconds, 0 disables counting
+        #table_stats_interval = 60
+
         ## compare/repair
         # max amount of time table can be locked
         #lock_timeout = 10
@@ -360,10 +450,35 @@ class Replicator(CascadedWorker):
     cur_tick = 0
     prev_tick = 0
     copy_table_name = None  # filled by Copytable()
-    sql_list: List[str] = []
+    sql_list: List[Union[str, RowBatch]] = []
+    sql_events: List[Optional[Event]] = []
+    sql_count = 0
+    sql_bytes = 0
+    sql_start = 0.0
+
+    apply_batch_count = 200
+    apply_batch_bytes = 0
+    apply_batch_delay = 0.0
+    apply_batch_autotune = False
+    apply_batch_target_latency = 0.1
 
     current_event = None
 
+    batch_prefetch = False
+    batch_prefetch_chunks = 4
+    prefetch_walker: Optional[PrefetchBatchWalker] = None
+
+    metrics_file: Optional[str] = None
+    metrics_interval = 60.0
+    metrics_written = 0.0
+    table_stats_interval = 60.0
+    table_stats_flushed = 0.0
+
+    table_list: List[TableState] = []
+
+    # version of londiste.table_info contents at last load_table_state()
+    table_state_stamp: Optional[str] = None
+
     threaded_copy_tables: List[str]
     threaded_copy_pool_size: int
     copy_method_map: Dict[str, Optional[int]]
@@ -375,10 +490,15 @@ class Replicator(CascadedWorker):
 
     deny_trigger_manager = None
 
+    copy_scheduler: Optional[CopyScheduler] = None
+    fkey_validator: Optional[FkeyValidator] = None
+
     def __init__(self, args):
         """Replication init."""
 
         self.event_filter_config = {}
+        self.event_filters = {}
+        self.event_filter_pushdown = None
         self.replica_mode_enabled = True
         # whether deny filters should be managed automatically
         self.deny_triggers_automatic_management = False
@@ -402,9 +522,26 @@ class Replicator(CascadedWorker):
         self.parallel_copies = self.cf.getint('parallel_copies', 1)
         if self.parallel_copies < 1:
             raise Exception('Bad value for parallel_copies: %d' % self.parallel_copies)
+        self.copy_pool = self.cf.getboolean('copy_pool', False)
+        self.copy_order = self.cf.get('copy_order', 'default')
+        if self.copy_order not in COPY_ORDERS:
+            raise Exception('Bad value for copy_order: %s' % self.copy_order)
+        self.copy_large_table_size = self.cf.getbytes('copy_large_table_size', '1G')
+
+        self.fkey_validate_workers = self.cf.getint('fkey_validate_workers', 0)
+
+        self.table_state_notify = self.cf.getboolean('table_state_notify', True)
+        if self.table_state_notify:
+            self.listen('db', TABLE_STATE_CHANNEL)
 
         self.consumer_filter = None
 
+        self.batch_metrics = BatchMetrics()
+        self.table_counters = TableCounters()
+
+        self.prepared_statements = PreparedStatementCache(
+            self.cf.getint('prepared_statement_cache_size', 100))
+
         self.register_only_tables = self.cf.getlist("register_only_tables", [])
         self.register_only_seqs = self.cf.getlist("register_only_seqs", [])
         self.register_skip_tables = self.cf.getlist("register_skip_tables", [])
@@ -422,6 +559,10 @@ class Replicator(CascadedWorker):
 
         load_handler_modules(self.cf)
 
+        # handler modules may have changed
+        self.table_state_stamp = None
+        self.drop_table_handlers()
+
         self.threaded_copy_tables = self.cf.getlist('threaded_copy_tables', [])
         self.threaded_copy_pool_size = self.cf.getint('threaded_copy_pool_size', 1)
         self.copy_method_map = {}
@@ -431,6 +572,25 @@ class Replicator(CascadedWorker):
         self.register_skip_tables = self.cf.getlist("register_skip_tables", [])
         self.register_skip_seqs = self.cf.getlist("register_skip_seqs", [])
 
+        self.apply_batch_count = self.cf.getint('apply_batch_count', 200)
+        if self.apply_batch_count < 1:
+            raise Exception('Bad value for apply_batch_count: %d' % self.apply_batch_count)
+        self.apply_batch_bytes = self.cf.getint('apply_batch_bytes', 1024 * 1024)
+        self.apply_batch_delay = self.cf.getfloat('apply_batch_delay', 0)
+        self.apply_batch_autotune = self.cf.getboolean('apply_batch_autotune', False)
+        self.apply_batch_target_latency = self.cf.getfloat('apply_batch_target_latency', 0.1)
+
+        self.batch_prefetch = self.cf.getboolean('batch_prefetch', False)
+        self.batch_prefetch_chunks = self.cf.getint('batch_prefetch_chunks', 4)
+
+        self.max_evbuf = self.cf.getint('copy_event_buffer', 5000)
+        if self.max_evbuf < 1:
+            raise Exception('Bad value for copy_event_buffer: %d' % self.max_evbuf)
+
+        self.metrics_file = self.cf.getfile('metrics_file', '') or None
+        self.metrics_interval = self.cf.getfloat('metrics_interval', 60)
+        self.table_stats_interval = self.cf.getfloat('table_stats_interval', 60)
+
     def fill_copy_method(self):
         for table_name in self.table_map:
             if table_name not in self.copy_method_map:
@@ -441,7 +601,32 @@ class Replicator(CascadedWorker):
                 if table_name not in self.copy_method_map:
                     self.copy_method_map[table_name] = None
 
+    def reset(self):
+        """Forget cached table state, it may not match database after rollback."""
+        self.table_state_stamp = None
+        self.drop_table_handlers()
+        # temp tables created in rolled back transaction are gone
+        BaseHandler.catalog_cache.clear()
+        if self.prefetch_walker:
+            self.prefetch_walker.stop()
+            self.prefetch_walker = None
+        super().reset()
+
+    def _load_batch_events(self, curs, batch_id):
+        """Use read-ahead walker if configured."""
+        if not (self.batch_prefetch and self.pgq_lazy_fetch):
+            return super()._load_batch_events(curs, batch_id)
+
+        db = self.get_database('_prefetch_db', connstr=self.provider_connstr, profile='remote')
+        self.prefetch_walker = PrefetchBatchWalker(db, batch_id, self.queue_name, self.pgq_lazy_fetch,
+                                                   self.consumer_filter, self.batch_prefetch_chunks)
+        return self.prefetch_walker
+
     def connection_hook(self, dbname, db):
+        if dbname == 'db':
+            # new session, no statements prepared or temp tables created
+            self.prepared_statements.clear()
+            BaseHandler.catalog_cache.clear()
         if dbname == 'db' and self.replica_mode_enabled:
             curs = db.cursor()
             curs.execute("select londiste.set_session_replication_role('replica', false)")
@@ -460,6 +645,9 @@ class Replicator(CascadedWorker):
         "All work for a batch.  Entry point from SetConsumer."
 
         self.current_event = None
+        batch_start = time.perf_counter()
+        timer = self.batch_metrics.timer
+        self.batch_metrics.start_batch()
 
         # this part can play freely with transactions
 
@@ -473,14 +661,18 @@ class Replicator(CascadedWorker):
         self.prev_tick = self.batch_info['prev_tick_id']
 
         dst_curs = dst_db.cursor()
-        self.load_table_state(dst_curs)
-        self.sync_tables(src_db, dst_db)
+        with timer('load_table_state'):
+            self.load_table_state(dst_curs)
+        with timer('sync_tables'):
+            self.sync_tables(src_db, dst_db)
 
-        self.copy_snapshot_cleanup(dst_db)
+        with timer('copy_snapshot_cleanup'):
+            self.copy_snapshot_cleanup(dst_db)
 
         # only main thread is allowed to restore fkeys
         if not self.copy_thread and self._worker_state.process_events:
-            self.restore_fkeys(dst_db)
+            with timer('restore_fkeys'):
+                self.restore_fkeys(dst_db)
 
         for p in self.used_plugins.values():
             p.reset()
@@ -492,17 +684,40 @@ class Replicator(CascadedWorker):
         # the cascade-consumer can save last tick and commit.
 
         self.sql_list = []
-        super().process_remote_batch(src_db, tick_id, ev_list, dst_db)
-        self.flush_sql(dst_curs)
-
-        for p in self.used_plugins.values():
-            p.finish_batch(self.batch_info, dst_curs)
+        self.sql_events = []
+        self.sql_count = 0
+        self.sql_bytes = 0
+        with timer('process_events'):
+            super().process_remote_batch(src_db, tick_id, ev_list, dst_db)
+        with timer('flush_sql'):
+            self.flush_sql(dst_curs)
+        self.stat_put('apply_batch_count', self.apply_batch_count)
+
+        with timer('finish_batch'):
+            for p in self.used_plugins.values():
+                if self.table_stats_interval > 0:
+                    t0 = time.perf_counter()
+                    p.finish_batch(self.batch_info, dst_curs)
+                    self.table_counters.finished(p.dest_table, time.perf_counter() - t0)
+                else:
+                    p.finish_batch(self.batch_info, dst_curs)
+            # handlers may queue rows collected during batch
+            self.flush_sql(dst_curs)
         self.used_plugins = {}
 
         # finalize table changes
-        self.save_table_state(dst_curs)
+        with timer('save_table_state'):
+            self.save_table_state(dst_curs)
+
+        # only waits in sync_tables look at notifications
+        if self.table_state_notify:
+            del dst_db.notifies[:]
+
+        self.batch_metrics.observe('batch', time.perf_counter() - batch_start)
+        self.report_batch_metrics()
 
         # store event filter
+        consumer_filter = None
         if self.cf.getboolean('local_only', False):
             # create list of tables
             if self.copy_thread:
@@ -513,12 +728,41 @@ class Replicator(CascadedWorker):
             # build filter
             meta = "(ev_type like 'pgq.%' or ev_type like 'londiste.%')"
             if _filterlist:
-                self.consumer_filter = "(%s or (ev_extra1 in (%s)))" % (meta, _filterlist)
+                consumer_filter = "(%s or (ev_extra1 in (%s)))" % (meta, _filterlist)
             else:
-                self.consumer_filter = meta
-        else:
-            # no filter
-            self.consumer_filter = None
+                consumer_filter = meta
+
+        # filtered events must not be needed by downstream nodes
+        if self.event_filter_pushdown and not (self.main_worker and self._worker_state.copy_events):
+            if consumer_filter:
+                consumer_filter = "%s and %s" % (consumer_filter, self.event_filter_pushdown)
+            else:
+                consumer_filter = self.event_filter_pushdown
+
+        self.consumer_filter = consumer_filter
+
+    def report_batch_metrics(self):
+        """Add phase durations to stats, write metrics file if due."""
+        for phase, secs in self.batch_metrics.last.items():
+            self.stat_increase('time_' + phase, secs)
+
+        now = time.time()
+        if self.table_stats_interval > 0 and now - self.table_stats_flushed >= self.table_stats_interval:
+            self.table_stats_flushed = now
+            for table, vals in sorted(self.table_counters.flush().items()):
+                res = ["%s: %s" % (k, v) for k, v in vals.items()]
+                self.log.info("Table stats: %s {%s}", table, ", ".join(res))
+
+        if not self.metrics_file:
+            return
+        if now - self.metrics_written < self.metrics_interval:
+            return
+        self.metrics_written = now
+        labels = {'job': self.job_name}
+        try:
+            self.batch_metrics.write_file(self.metrics_file, labels, self.table_counters.format_metrics(labels))
+        except OSError as ex:
+            self.log.warning("Cannot write metrics file %s: %s", self.metrics_file, ex)
 
     def sync_tables(self, src_db, dst_db):
         """Table sync loop.
@@ -546,7 +790,7 @@ class Replicator(CascadedWorker):
                 raise Exception('Program error')
 
             self.log.debug('Sync tables: sleeping')
-            time.sleep(3)
+            self.wait_table_state(dst_db, 3)
             dst_db.commit()
             self.load_table_state(dst_db.cursor())
             dst_db.commit()
@@ -593,12 +837,24 @@ class Replicator(CascadedWorker):
             self.pgq_min_interval = self.dsync_backup[2]
             self.dsync_backup = None
 
+        if self.copy_pool:
+            self.check_copy_pool()
+
         # now handle new copies
         npossible = self.parallel_copies - cnt.get_copy_count()
         if cnt.missing and npossible > 0:
             pmap = self.get_state_map(src_db.cursor())
             src_db.commit()
-            for t in self.get_tables_in_state(TABLE_MISSING):
+            missing = list(self.get_tables_in_state(TABLE_MISSING))
+            sizes = {}
+            nlarge = 0
+            if self.copy_order != 'default':
+                sizes = self.get_provider_table_sizes(src_db, pmap)
+                missing = self.order_copy_tables(missing, sizes)
+                nlarge = len([t for t in self.table_list
+                              if t.state != TABLE_MISSING and t.state != TABLE_OK
+                              and sizes.get(t.name, 0) >= self.copy_large_table_size])
+            for t in missing:
                 if 'copy_node' in t.table_attrs:
                     # should we go and check this node?
                     pass
@@ -615,6 +871,13 @@ class Replicator(CascadedWorker):
                 # don't allow more copies than configured
                 if npossible == 0:
                     break
+
+                # keep one slot free for small tables
+                if self.copy_order == 'fair' and sizes.get(t.name, 0) >= self.copy_large_table_size:
+                    if self.parallel_copies > 1 and nlarge >= self.parallel_copies - 1:
+                        self.log.debug("Table %s: too many large tables in copy, waiting", t.name)
+                        continue
+                    nlarge += 1
                 npossible -= 1
 
                 # drop all foreign keys to and from this table
@@ -730,13 +993,17 @@ class Replicator(CascadedWorker):
             self.flush_sql(dst_curs)
             self.handle_truncate_event(ev, src_curs, dst_curs)
         elif ev.type == 'EXECUTE':
-            self.flush_sql(dst_curs)
+            self.flush_handlers(dst_curs)
+            self.prepared_statements.clear(dst_curs)
+            BaseHandler.catalog_cache.clear()
             self.handle_execute_event(ev, dst_curs)
         elif ev.type == 'londiste.add-table':
             self.flush_sql(dst_curs)
+            self.prepared_statements.clear(dst_curs)
             self.add_set_table(dst_curs, ev.data)
         elif ev.type == 'londiste.remove-table':
             self.flush_sql(dst_curs)
+            self.prepared_statements.clear(dst_curs)
             self.remove_set_table(dst_curs, ev.data)
         elif ev.type == 'londiste.remove-seq':
             self.flush_sql(dst_curs)
@@ -757,11 +1024,24 @@ class Replicator(CascadedWorker):
         """handle one data event"""
         table_name = ev.extra1
         t = self.get_table_by_name(table_name)
-        if not t or not t.interesting(ev, self.cur_tick, self.copy_thread, self.copy_table_name) \
-                or not self.is_filter_condition_true(ev):
+        count_stats = self.table_stats_interval > 0
+        if not t or not t.interesting(ev, self.cur_tick, self.copy_thread, self.copy_table_name):
             self.stat_increase('ignored_events')
+            if count_stats:
+                self.table_counters.ignored(t.dest_table if t else table_name, ev.type[0], len(ev.data or ''))
             return
 
+        # decode row only once, for both filter and handler
+        row = None
+        event_filter = self.event_filters.get(table_name)
+        if event_filter:
+            row = parse_event_row(ev)
+            if not event_filter.check(row):
+                self.stat_increase('ignored_events')
+                if count_stats:
+                    self.table_counters.ignored(t.dest_table, ev.type[0], len(ev.data or ''))
+                return
+
         if table_name in self.used_plugins:
             p = self.used_plugins[table_name]
         else:
@@ -771,7 +1051,25 @@ class Replicator(CascadedWorker):
 
         self.stat_increase('#'+ev.type[0])
 
-        p.process_event(ev, apply_func, dst_curs)
+        if row is not None:
+            p.set_parsed_row(ev, row)
+        if count_stats:
+            t0 = time.perf_counter()
+            p.process_event(ev, apply_func, dst_curs)
+            self.table_counters.applied(p.dest_table, ev.type[0], len(ev.data or ''), time.perf_counter() - t0)
+        else:
+            p.process_event(ev, apply_func, dst_curs)
+
+        if self.work_state < 0 and p.flush_on_retry:
+            # rows must not be held back, so failing event is known
+            p.flush_pending(dst_curs)
+
+    def flush_handlers(self, dst_curs):
+        """Apply rows held back by handlers and queued statements."""
+        self.flush_sql(dst_curs)
+        for p in self.used_plugins.values():
+            p.flush_pending(dst_curs)
+        self.flush_sql(dst_curs)
 
     def handle_truncate_event(self, ev, src_curs, dst_curs):
         """handle one truncate event"""
@@ -794,6 +1092,9 @@ class Replicator(CascadedWorker):
             self.log.info("ignoring truncate for %s", fqname)
             return
 
+        # rows collected by handler so far are truncated anyway
+        p.reset()
+
         #
         # Always use CASCADE, because without it the
         # operation cannot work with FKeys, on both
@@ -801,7 +1102,8 @@ class Replicator(CascadedWorker):
         #
         sql = "TRUNCATE %s CASCADE;" % fqname
 
-        self.flush_sql(dst_curs)
+        # rows held for other tables must be there for cascade
+        self.flush_handlers(dst_curs)
         dst_curs.execute(sql)
 
     def handle_execute_event(self, ev, dst_curs):
@@ -855,25 +1157,104 @@ class Replicator(CascadedWorker):
 
     def apply_sql(self, sql, dst_curs):
 
-        # how many queries to batch together, drop batching on error
-        limit = 200
-        if self.work_state == -1:
-            limit = 0
+        if not self.sql_list and self.apply_batch_delay:
+            self.sql_start = time.time()
 
-        self.sql_list.append(sql)
-        if len(self.sql_list) >= limit:
+        if self.work_state == -1:
+            # retry after error: plain statement per event, so that
+            # flush_sql can bisect to the failing one
+            if isinstance(sql, RowBatch):
+                sql = sql.get_sql()
+            self.sql_list.append(sql)
+            self.sql_events.append(self.current_event)
+        else:
+            # prepared statements are tracked in queue order
+            if isinstance(sql, RowBatch) and sql.prepared:
+                sql = self.prepared_statements.get_sql(sql)
+
+            # merge row into previous multi-row statement if possible
+            if not (isinstance(sql, RowBatch) and self.sql_list
+                    and isinstance(self.sql_list[-1], RowBatch)
+                    and self.sql_list[-1].merge(sql)):
+                self.sql_list.append(sql)
+        self.sql_count += 1
+        self.sql_bytes += len(sql) if isinstance(sql, str) else sql.get_size()
+
+        # how many queries to batch together
+        if self.sql_count >= self.apply_batch_count:
+            self.flush_sql(dst_curs, self.apply_batch_autotune)
+        elif self.apply_batch_bytes and self.sql_bytes >= self.apply_batch_bytes:
+            self.flush_sql(dst_curs)
+        elif self.apply_batch_delay and time.time() - self.sql_start >= self.apply_batch_delay:
             self.flush_sql(dst_curs)
 
-    def flush_sql(self, dst_curs):
+    def flush_sql(self, dst_curs, autotune=False):
         """Send all buffered statements to DB."""
 
         if len(self.sql_list) == 0:
             return
 
-        buf = "\n".join(self.sql_list)
+        stmts = [sql if isinstance(sql, str) else sql.get_sql() for sql in self.sql_list]
+        events = self.sql_events
+        buf = "\n".join(stmts)
         self.sql_list = []
+        self.sql_events = []
+        self.sql_count = 0
+        self.sql_bytes = 0
+
+        start = time.time()
+        if self.work_state == -1:
+            if len(events) != len(stmts):
+                events = [None] * len(stmts)
+            self.bisect_sql(dst_curs, stmts, events)
+        else:
+            dst_curs.execute(buf)
+        latency = time.time() - start
+
+        self.stat_increase('apply_flushes')
+        self.stat_increase('apply_flush_time', latency)
+        self.stat_increase('apply_flush_bytes', len(buf))
+
+        if autotune:
+            self.autotune_apply_batch(latency)
+
+    def bisect_sql(self, dst_curs, stmts, events):
+        """Apply statements under savepoint, on error split in half.
+
+        Failing single statement is executed without savepoint, its
+        event is left in current_event for exception_hook.
+        """
+        if len(stmts) == 1:
+            prev_event = self.current_event
+            self.current_event = events[0] or prev_event
+            dst_curs.execute(stmts[0])
+            self.current_event = prev_event
+            return
 
-        dst_curs.execute(buf)
+        dst_curs.execute("savepoint londiste_bisect")
+        try:
+            dst_curs.execute("\n".join(stmts))
+        except Exception as ex:
+            self.log.warning("Chunk of %d statements failed, bisecting: %s", len(stmts), str(ex).strip())
+            dst_curs.execute("rollback to savepoint londiste_bisect; release savepoint londiste_bisect")
+            self.stat_increase('apply_bisect_splits')
+            mid = len(stmts) // 2
+            self.bisect_sql(dst_curs, stmts[:mid], events[:mid])
+            self.bisect_sql(dst_curs, stmts[mid:], events[mid:])
+            return
+        dst_curs.execute("release savepoint londiste_bisect")
+
+    def autotune_apply_batch(self, latency):
+        """Adjust statement count limit by latency of full flush."""
+        count = self.apply_batch_count
+        if latency > self.apply_batch_target_latency:
+            count = max(AUTOTUNE_MIN_COUNT, count * 3 // 4)
+        elif latency < self.apply_batch_target_latency / 2:
+            count = min(AUTOTUNE_MAX_COUNT, count * 3 // 2)
+        if count != self.apply_batch_count:
+            self.log.debug("apply_batch_count: %d -> %d (flush latency %.3f)",
+                           self.apply_batch_count, count, latency)
+            self.apply_batch_count = count
 
     def add_set_table(self, dst_curs, tbl):
         """There was new table added to root, remember it."""
@@ -900,13 +1281,27 @@ class Replicator(CascadedWorker):
         q = "select londiste.global_remove_seq(%s, %s)"
         dst_curs.execute(q, [self.set_name, seq])
 
+    def drop_table_handlers(self):
+        """Build new handler instances on next load_table_state()."""
+        for t in self.table_list:
+            t.drop_plugin()
+
     def load_table_state(self, curs):
         """Load table state from database.
 
-        Todo: if all tables are OK, there is no need
-        to load state on every batch.
+        Full reload happens only if londiste.table_info has changed
+        since previous load, otherwise cached table states and their
+        handlers are kept.  On full reload, handler instance is kept
+        if handler string and dest_table are unchanged.
         """
 
+        q = "select coalesce(md5(string_agg(ctid::text || ':' || xmin::text, ',' order by ctid)), '')"\
+            " from londiste.table_info"
+        curs.execute(q)
+        stamp = curs.fetchone()[0]
+        if stamp == self.table_state_stamp:
+            return
+
         q = "select * from londiste.get_table_list(%s)"
         curs.execute(q, [self.set_name])
 
@@ -933,6 +1328,7 @@ class Replicator(CascadedWorker):
 
         self.table_list = new_list
         self.table_map = new_map
+        self.table_state_stamp = stamp
 
         self.fill_copy_method()
 
@@ -952,27 +1348,79 @@ class Replicator(CascadedWorker):
         return new_map
 
     def save_table_state(self, curs):
-        """Store changed table state in database."""
+        """Store changed table state in database.
 
+        All changes are sent in one round trip.
+        """
+        dest_names, dest_tables = [], []
+        names, snapshots, states = [], [], []
         for t in self.table_list:
             # backwards compat: move plugin-only dest_table to table_info
             if t.dest_table != t.plugin.dest_table:
                 self.log.info("Overwriting .dest_table from plugin: tbl=%s  dst=%s",
                               t.name, t.plugin.dest_table)
-                q = "update londiste.table_info set dest_table = %s"\
-                    " where queue_name = %s and table_name = %s"
-                curs.execute(q, [t.plugin.dest_table, self.set_name, t.name])
+                dest_names.append(t.name)
+                dest_tables.append(t.plugin.dest_table)
 
             if not t.changed:
                 continue
             merge_state = t.render_state()
             self.log.info("storing state of %s: copy:%d new_state:%s",
                           t.name, self.copy_thread, merge_state)
-            q = "select londiste.local_set_table_state(%s, %s, %s, %s)"
-            curs.execute(q, [self.set_name,
-                             t.name, t.str_snapshot, merge_state])
+            names.append(t.name)
+            snapshots.append(t.str_snapshot)
+            states.append(merge_state)
             t.changed = 0
 
+        sql_list = []
+        args = []
+        if dest_names:
+            sql_list.append("update londiste.table_info i set dest_table = u.dest_table"
+                            "  from unnest(%s::text[], %s::text[]) as u (table_name, dest_table)"
+                            " where i.queue_name = %s and i.table_name = u.table_name")
+            args += [dest_names, dest_tables, self.set_name]
+        if names:
+            sql_list.append("select londiste.local_set_table_state(%s, s.table_name, s.snapshot, s.merge_state)"
+                            "  from unnest(%s::text[], %s::text[], %s::text[])"
+                            "       as s (table_name, snapshot, merge_state)")
+            args += [self.set_name, names, snapshots, states]
+            if self.table_state_notify:
+                # wake up processes waiting for table state change, sent on commit
+                sql_list.append("select pg_notify(%s, %s)")
+                args += [TABLE_STATE_CHANNEL, self.set_name]
+        if sql_list:
+            curs.execute(";\n".join(sql_list), args)
+
+    def work(self):
+        if self.table_state_notify:
+            # table state is reloaded on each batch anyway
+            del self.get_database('db').notifies[:]
+        return super().work()
+
+    def wait_table_state(self, dst_db, timeout):
+        """Sleep until table state change is notified or timeout passes.
+
+        Ends current transaction, notifications are not delivered inside one.
+        """
+        dst_db.commit()
+        if not self.table_state_notify:
+            time.sleep(timeout)
+            return
+
+        # own changes are notified to this session too
+        own_pid = dst_db.get_backend_pid()
+        deadline = time.time() + timeout
+        while True:
+            # notification may have arrived together with earlier query results
+            dst_db.poll()
+            notified = any(n.pid != own_pid for n in dst_db.notifies)
+            del dst_db.notifies[:]
+            left = deadline - time.time()
+            if notified or left <= 0:
+                return
+            # wake up when anything arrives on connection
+            select.select([dst_db], [], [], left)
+
     def change_table_state(self, dst_db, tbl, state, tick_id=None):
         """Chage state for table."""
 
@@ -989,6 +1437,41 @@ class Replicator(CascadedWorker):
             if t.state == state:
                 yield t
 
+    def get_provider_table_sizes(self, src_db, pmap):
+        """Estimated size in bytes of provider tables, from pg_class stats."""
+        names = [t.name for t in self.table_list if t.state != TABLE_OK and t.name in pmap]
+        if not names:
+            return {}
+        qnames = [skytools.quote_fqident(pmap[name].dest_table) for name in names]
+        # reltuples < 0 means never analyzed, then relpages is 0 too
+        q = "select t.name, case when c.reltuples < 0 then pg_catalog.pg_relation_size(c.oid)"\
+            "        else c.relpages::int8 * current_setting('block_size')::int8 end as size"\
+            "  from unnest(%s::text[], %s::text[]) as t (name, qname)"\
+            "  join pg_catalog.pg_class c on (c.oid = to_regclass(t.qname))"
+        curs = src_db.cursor()
+        curs.execute(q, [names, qnames])
+        sizes = {}
+        for row in curs.fetchall():
+            sizes[row['name']] = row['size']
+        src_db.commit()
+        return sizes
+
+    def order_copy_tables(self, tables, sizes):
+        """Sort tables to be copied according to copy_order."""
+        if self.copy_order == 'smallest':
+            return sorted(tables, key=lambda t: sizes.get(t.name, 0))
+        if self.copy_order == 'largest':
+            return sorted(tables, key=lambda t: sizes.get(t.name, 0), reverse=True)
+        if self.copy_order == 'fair':
+            # small ones first, then largest ones, as they take longest
+            large = self.copy_large_table_size
+            small_list = [t for t in tables if sizes.get(t.name, 0) < large]
+            large_list = [t for t in tables if sizes.get(t.name, 0) >= large]
+            small_list.sort(key=lambda t: sizes.get(t.name, 0))
+            large_list.sort(key=lambda t: sizes.get(t.name, 0), reverse=True)
+            return small_list + large_list
+        return list(tables)
+
     def get_table_by_name(self, name):
         """Returns cached state object."""
         if name.find('.') < 0:
@@ -997,18 +1480,61 @@ class Replicator(CascadedWorker):
             return self.table_map[name]
         return None
 
+    def get_copy_args(self, tbl_stat):
+        """Args for copy script, with same verbosity options as main script got."""
+        args = [self.cf.filename, 'copy', tbl_stat.name]
+        if self.options.quiet:
+            args.append('-q')
+        if self.options.verbose:
+            args += ['-v'] * self.options.verbose
+        return args
+
+    def check_copy_pool(self):
+        """Report finished copies, restart copies lost with previous worker process."""
+        scheduler = self.get_copy_scheduler()
+        for table_name, status in scheduler.poll():
+            if status == 'ok':
+                self.log.info("Copy of %s finished", table_name)
+                self.stat_increase('copies_finished')
+            else:
+                self.log.error("Copy of %s failed: %s", table_name, status)
+                self.stat_increase('copies_failed')
+
+        for t in self.table_list:
+            if t.state not in (TABLE_IN_COPY, TABLE_CATCHING_UP, TABLE_WANNA_SYNC, TABLE_DO_SYNC):
+                continue
+            if scheduler.is_running(t.name):
+                continue
+            copy_pidfile = "%s.copy.%s" % (self.pidfile, t.name)
+            if skytools.signal_pidfile(copy_pidfile, 0):
+                continue
+            self.log.info("No copy process for %s, restarting", t.name)
+            scheduler.submit(t.name, self.get_copy_args(t))
+
+        self.stat_put('copies_running', len(scheduler.running))
+
+    def get_copy_scheduler(self):
+        if self.copy_scheduler is None:
+            self.copy_scheduler = CopyScheduler(self.parallel_copies, self.log)
+        return self.copy_scheduler
+
+    def shutdown(self):
+        if self.copy_scheduler is not None:
+            self.copy_scheduler.shutdown()
+        if self.fkey_validator is not None:
+            self.fkey_validator.shutdown()
+        super().shutdown()
+
     def launch_copy(self, tbl_stat):
         """Run parallel worker for copy."""
+        if self.copy_pool:
+            self.log.info("Scheduling copy of %s", tbl_stat.name)
+            self.get_copy_scheduler().submit(tbl_stat.name, self.get_copy_args(tbl_stat))
+            return
+
         self.log.info("Launching copy process")
         main_exe = sys.argv[0]
-        conf = self.cf.filename
-        cmd = [main_exe, conf, 'copy', tbl_stat.name, '-d']
-
-        # pass same verbosity options as main script got
-        if self.options.quiet:
-            cmd.append('-q')
-        if self.options.verbose:
-            cmd += ['-v'] * self.options.verbose
+        cmd = [main_exe] + self.get_copy_args(tbl_stat) + ['-d']
 
         # let existing copy finish and clean its pidfile,
         # otherwise new copy will exit immediately.
@@ -1069,12 +1595,49 @@ class Replicator(CascadedWorker):
             q = "select * from londiste.get_valid_pending_fkeys(%s)"
         dst_curs.execute(q, [self.set_name])
         fkey_list = dst_curs.fetchall()
+        if self.fkey_validate_workers > 0:
+            self.restore_fkeys_not_valid(dst_db, fkey_list)
+            return
         for row in fkey_list:
             self.log.info('Creating fkey: %s (%s --> %s)', row['fkey_name'], row['from_table'], row['to_table'])
             q2 = "select londiste.restore_table_fkey(%(from_table)s, %(fkey_name)s)"
             dst_curs.execute(q2, row)
             dst_db.commit()
 
+    def restore_fkeys_not_valid(self, dst_db, fkey_list):
+        """Create fkeys without checking existing rows, validate them in background."""
+        dst_curs = dst_db.cursor()
+        if self.fkey_validator is None:
+            self.fkey_validator = FkeyValidator(self.cf.get('db'), self.fkey_validate_workers, self.log)
+            # continue validations interrupted by restart
+            self.fkey_validator.add_unvalidated(dst_curs)
+            dst_db.commit()
+
+        for row in fkey_list:
+            self.log.info('Creating fkey as not valid: %s (%s --> %s)',
+                          row['fkey_name'], row['from_table'], row['to_table'])
+            fkey_def = row['fkey_def']
+            validate = 'NOT VALID' not in fkey_def.upper()
+            if validate:
+                fkey_def += ' NOT VALID'
+            q = "alter table only %s add constraint %s %s" % (
+                skytools.quote_fqident(row['from_table']), skytools.quote_ident(row['fkey_name']), fkey_def)
+            dst_curs.execute(q)
+            if validate:
+                self.fkey_validator.mark(dst_curs, row['from_table'], row['fkey_name'])
+            q = "delete from londiste.pending_fkeys where from_table = %s and fkey_name = %s"
+            dst_curs.execute(q, [row['from_table'], row['fkey_name']])
+            dst_db.commit()
+            if validate:
+                self.fkey_validator.add(row['from_table'], row['fkey_name'])
+
+        ok, failed = self.fkey_validator.poll()
+        if ok:
+            self.stat_increase('fkeys_validated', ok)
+        if failed:
+            self.stat_increase('fkeys_validate_failed', failed)
+        self.stat_put('fkeys_validating', len(self.fkey_validator.running))
+
     def drop_fkeys(self, dst_db, table_name):
         """Drop all foreign keys to and from this table.
 
@@ -1087,8 +1650,13 @@ class Replicator(CascadedWorker):
         fkey_list = dst_curs.fetchall()
         for row in fkey_list:
             self.log.info('Dropping fkey: %s', row['fkey_name'])
+            # saved definition of unvalidated fkey includes NOT VALID,
+            # and validation mark is dropped with constraint
+            marked = is_marked(dst_curs, row['from_table'], row['fkey_name'])
             q2 = "select londiste.drop_table_fkey(%(from_table)s, %(fkey_name)s)"
             dst_curs.execute(q2, row)
+            if marked:
+                unmark_pending(dst_curs, row['from_table'], row['fkey_name'])
             dst_db.commit()
 
     def process_root_node(self, dst_db):
@@ -1117,7 +1685,8 @@ class Replicator(CascadedWorker):
 
         if is_data_event(ev):
             t = self.get_table_by_name(ev.extra1)
-            if t:
+            # skip handler setup when it does not rewrite events
+            if t and t.get_plugin().rewrites_copy_event():
                 try:
                     p = self.used_plugins[ev.extra1]
                 except KeyError:
@@ -1149,6 +1718,10 @@ class Replicator(CascadedWorker):
             with open(event_filter_config_file, 'r') as stream:
                 self.event_filter_config = yaml.safe_load(stream)
             self.log.info('Filter: ' + str(self.event_filter_config))
+            self.event_filters = load_event_filters(self.event_filter_config)
+            if cf.getboolean('event_filter_pushdown', False):
+                self.event_filter_pushdown = get_pushdown_filter(self.event_filters)
+                self.log.info('Filter pushdown: %s', self.event_filter_pushdown)
 
         if cf.has_option('replica_mode_enabled'):
             self.replica_mode_enabled = cf.getboolean('replica_mode_enabled')
@@ -1162,13 +1735,10 @@ class Replicator(CascadedWorker):
         return cf
 
     def is_filter_condition_true(self, ev):
-        event_filter = self.event_filter_config.get(ev.extra1, None)
-        if not (event_filter and event_filter['partialSync']):
+        event_filter = self.event_filters.get(ev.extra1)
+        if not event_filter:
             return True
-        filterCode = event_filter['partialConditionSlave']
-        data = skytools.db_urldecode(ev.data)
-        result = eval(filterCode, data)
-        return result
+        return event_filter.check(parse_event_row(ev))
 
 if __name__ == '__main__':
     script = Replicator(sys.argv[1:])
@@ -0,0 +1,96 @@
+"""Batch event read-ahead.
+
+PgQ does not give out next batch before current one is finished,
+so the overlap happens inside the batch: a background thread reads
+event rows on a separate provider connection, while main thread
+applies already fetched ones.
+"""
+
+import queue
+import threading
+
+from pgq.baseconsumer import BaseBatchWalker
+
+__all__ = ['PrefetchBatchWalker']
+
+# marks end of rows in queue
+_END = None
+
+
+class PrefetchBatchWalker(BaseBatchWalker):
+    """Batch walker that fetches rows in background thread.
+
+    Behaves like BaseBatchWalker: single iteration in event order,
+    len() after that.  At most max_chunks blocks of fetch_size rows
+    are kept in memory.
+    """
+
+    def __init__(self, db, batch_id, queue_name, fetch_size=300, consumer_filter=None, max_chunks=4):
+        super().__init__(db.cursor(), batch_id, queue_name, fetch_size, consumer_filter)
+        self.sql_cursor = "batch_prefetch"
+        self.db = db
+        self.chunks = queue.Queue(max(max_chunks, 1))
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def _put(self, item):
+        """Wait for free slot, give up if stopped."""
+        while not self.stop_event.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch_thread(self):
+        try:
+            q = "select * from pgq.get_batch_cursor(%s, %s, %s, %s)"
+            self.curs.execute(q, [self.batch_id, self.sql_cursor, self.fetch_size, self.consumer_filter])
+            q = "fetch %d from %s" % (self.fetch_size, self.sql_cursor)
+            while True:
+                rows = self.curs.fetchall()
+                if rows and not self._put(rows):
+                    break
+                if len(rows) < self.fetch_size:
+                    break
+                self.curs.execute(q)
+            self.curs.execute("close %s" % self.sql_cursor)
+            self.db.commit()
+        except BaseException as ex:
+            self.error = ex
+            try:
+                self.db.rollback()
+            except BaseException:
+                pass
+        self._put(_END)
+
+    def __iter__(self):
+        if self.fetch_status:
+            raise Exception("BatchWalker: double fetch? (%d)" % self.fetch_status)
+        self.fetch_status = 1
+
+        self.thread = threading.Thread(target=self._fetch_thread, name="batch-prefetch", daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                rows = self.chunks.get()
+                if rows is _END:
+                    break
+                self.length += len(rows)
+                for row in rows:
+                    yield self._make_event(self.queue_name, row)
+        finally:
+            self.stop()
+
+        if self.error:
+            raise self.error
+        self.fetch_status = 2
+
+    def stop(self):
+        """Stop background fetch and wait for thread to exit."""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -73,7 +73,7 @@ class CopyTableRest(ReplicatorRest):
                                 tbl_stat.max_parallel_copy)
             else:
                 break
-            time.sleep(10)
+            self.wait_table_state(dst_db, 10)
             tbl_stat = self.reload_table_stat(dst_curs, tbl_stat.name)
             dst_db.commit()
 
@@ -200,7 +200,7 @@ class CopyTableRest(ReplicatorRest):
             # start waiting for other copy processes to finish
             while tbl_stat.copy_role:
                 self.log.info('waiting for other partitions to finish copy')
-                time.sleep(10)
+                self.wait_table_state(dst_db, 10)
                 tbl_stat = self.reload_table_stat(dst_curs, tbl_stat.name)
                 dst_db.commit()
 
@@ -49,6 +49,7 @@ class CopyTable(Replicator):
         """ Override Replicator.connection_hook and ensure 'replica' role is used for table copy in any circustances. """
 
         if dbname == 'db':
+            self.prepared_statements.clear()
             curs = db.cursor()
             curs.execute("select londiste.set_session_replication_role('replica', false)")
             self.log.info("Session replication role has been set to 'replica'")
@@ -81,7 +82,7 @@ class CopyTable(Replicator):
                               tbl_stat.max_parallel_copy)
             else:
                 break
-            time.sleep(10)
+            self.wait_table_state(dst_db, 10)
             tbl_stat = self.reload_table_stat(dst_curs, tbl_stat.name)
             dst_db.commit()
 
@@ -225,7 +226,7 @@ class CopyTable(Replicator):
             # start waiting for other copy processes to finish
             while tbl_stat.copy_role:
                 self.log.info('waiting for other partitions to finish copy')
-                time.sleep(10)
+                self.wait_table_state(dst_db, 10)
                 tbl_stat = self.reload_table_stat(dst_curs, tbl_stat.name)
                 dst_db.commit()
 